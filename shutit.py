@@ -282,6 +282,25 @@ def check_conflicts(shutit):
 	return errs
 
 
+def module_login(shutit, module_id):
+	"""Logs in to a shell for a module's phase (check_ready, build etc).
+	If warm_module_shells is configured, the module's shell from an earlier
+	phase is resumed if there is one.
+	"""
+	if shutit.build['warm_module_shells'] and shutit.resume_login(module_id):
+		return
+	shutit.login(prompt_prefix=module_id,command='bash --noprofile --norc',echo=False)
+
+
+def module_logout(shutit, module_id):
+	"""Logs out of a module's shell after a phase. If warm_module_shells is
+	configured, the shell is parked for the module's later phases instead.
+	"""
+	if shutit.build['warm_module_shells'] and shutit.park_login(module_id):
+		return
+	shutit.logout(echo=False)
+
+
 def check_ready(shutit, throw_error=True):
 	"""Check that all modules are ready to be built, calling check_ready on
 	each of those configured to be built and not already installed
@@ -297,14 +316,14 @@ def check_ready(shutit, throw_error=True):
 		shutit.log('considering check_ready (is it ready to be built?): ' + module_id, level=logging.DEBUG)
 		if cfg[module_id]['shutit.core.module.build'] and module.module_id not in shutit.get_current_shutit_pexpect_session_environment().modules_ready and not shutit_util.is_installed(shutit, module):
 			shutit.log('checking whether module is ready to build: ' + module_id, level=logging.DEBUG)
-			shutit.login(prompt_prefix=module_id,command='bash --noprofile --norc',echo=False)
+			module_login(shutit, module_id)
 			# Move to the correct directory (eg for checking for the existence of files needed for build)
 			revert_dir = os.getcwd()
 			shutit.get_current_shutit_pexpect_session_environment().module_root_dir = os.path.dirname(module.__module_file)
 			shutit.chdir(shutit.get_current_shutit_pexpect_session_environment().module_root_dir)
 			if not is_ready(shutit, module) and throw_error:
 				errs.append((module_id + ' not ready to install.\nRead the check_ready function in the module,\nor log messages above to determine the issue.\n\n', shutit.get_shutit_pexpect_session_from_id('target_child')))
-			shutit.logout(echo=False)
+			module_logout(shutit, module_id)
 			shutit.chdir(revert_dir)
 	return errs
 
@@ -322,7 +341,7 @@ def do_remove(shutit, loglevel=logging.DEBUG):
 		shutit.log('considering whether to remove: ' + module_id, level=logging.DEBUG)
 		if cfg[module_id]['shutit.core.module.remove']:
 			shutit.log('removing: ' + module_id, level=logging.DEBUG)
-			shutit.login(prompt_prefix=module_id,command='bash --noprofile --norc',echo=False)
+			module_login(shutit, module_id)
 			if not module.remove(shutit):
 				shutit.log(shutit_util.print_modules(shutit), level=logging.DEBUG)
 				shutit.fail(module_id + ' failed on remove', shutit_pexpect_child=shutit.get_shutit_pexpect_session_from_id('target_child').pexpect_child) # pragma: no cover
@@ -335,7 +354,7 @@ def do_remove(shutit, loglevel=logging.DEBUG):
 						shutit.get_current_shutit_pexpect_session_environment().modules_installed.remove(module.module_id)
 					# Add to "not installed" cache
 					shutit.get_current_shutit_pexpect_session_environment().modules_not_installed.append(module.module_id)
-			shutit.logout(echo=False)
+			module_logout(shutit, module_id)
 
 
 
@@ -402,9 +421,9 @@ def do_build(shutit):
 					revert_dir = os.getcwd()
 					shutit.get_current_shutit_pexpect_session_environment().module_root_dir = os.path.dirname(module.__module_file)
 					shutit.chdir(shutit.get_current_shutit_pexpect_session_environment().module_root_dir)
-					shutit.login(prompt_prefix=module_id,command='bash --noprofile --norc',echo=False)
+					module_login(shutit, module_id)
 					build_module(shutit, module)
-					shutit.logout(echo=False)
+					module_logout(shutit, module_id)
 					shutit.chdir(revert_dir)
 		if shutit_util.is_installed(shutit, module):
 			shutit.log('Starting module',level=logging.DEBUG)
@@ -426,10 +445,10 @@ def do_test(shutit):
 		# Only test if it's installed.
 		if shutit_util.is_installed(shutit, shutit.shutit_map[module_id]):
 			shutit.log('RUNNING TEST ON: ' + module_id, level=logging.DEBUG)
-			shutit.login(prompt_prefix=module_id,command='bash --noprofile --norc',echo=False)
+			module_login(shutit, module_id)
 			if not shutit.shutit_map[module_id].test(shutit):
 				shutit.fail(module_id + ' failed on test', shutit_pexpect_child=shutit.get_shutit_pexpect_session_from_id('target_child').pexpect_child) # pragma: no cover
-			shutit.logout(echo=False)
+			module_logout(shutit, module_id)
 
 
 def do_finalize(shutit=None):
@@ -445,10 +464,15 @@ def do_finalize(shutit=None):
 		for module_id in shutit_util.module_ids(shutit, rev=True):
 			# Only finalize if it's thought to be installed.
 			if shutit_util.is_installed(shutit, shutit.shutit_map[module_id]):
-				shutit.login(prompt_prefix=module_id,command='bash --noprofile --norc',echo=False)
+				module_login(shutit, module_id)
 				if not shutit.shutit_map[module_id].finalize(shutit):
 					shutit.fail(module_id + ' failed on finalize', shutit_pexpect_child=shutit.get_shutit_pexpect_session_from_id('target_child').pexpect_child) # pragma: no cover
+				# This is the last phase, so there is no need to park the shell.
 				shutit.logout(echo=False)
+		# Log out of any module shells still parked from earlier phases.
+		for shutit_pexpect_session in shutit.shutit_pexpect_sessions.values():
+			shutit_pexpect_session.logout_parked()
+			shutit_pexpect_session.clear_transfer_cache()
 	if shutit is None:
 		for shutit in shutit_global.shutit_global_object.shutit_objects:
 			_finalize(shutit)
@@ -725,6 +749,8 @@ def do_interactive_modules(shutit):
 							cfg[module_id][name] = newcfg_list
 						else:
 							cfg[module_id][name] = val
+						if name in ('password','passphrase'):
+							shutit_global.shutit_global_object.add_secret_word(cfg[module_id][name])
 					else:
 						break
 			else:
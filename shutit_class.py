@@ -274,6 +274,7 @@ class ShutIt(object):
 	                     shutit_pexpect_child=None,
 	                     echo=None,
 	                     note=None,
+	                     target_loop=False,
 	                     loglevel=logging.INFO):
 		"""Send string and require the item in the output.
 		See send_until
@@ -285,6 +286,7 @@ class ShutIt(object):
 		                                               not_there=not_there,
 		                                               echo=echo,
 		                                               note=note,
+		                                               target_loop=target_loop,
 		                                               loglevel=loglevel)
 
 
@@ -300,6 +302,9 @@ class ShutIt(object):
 	               debug_command=None,
 	               pause_point_on_fail=True,
 	               nonewline=False,
+	               timeout=None,
+	               backoff=1,
+	               target_loop=False,
 	               loglevel=logging.INFO):
 		"""Send string on a regular cadence until a string is either seen, or the timeout is triggered.
 
@@ -310,6 +315,9 @@ class ShutIt(object):
 		@param shutit_pexpect_child:                See send()
 		@param echo:                 See send()
 		@param note:                 See send()
+		@param timeout:              See ShutItPexpectSession.send_until()
+		@param backoff:              See ShutItPexpectSession.send_until()
+		@param target_loop:          See ShutItPexpectSession.send_until()
 		"""
 		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
 		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
@@ -323,7 +331,10 @@ class ShutIt(object):
 		                                         loglevel=loglevel,
 		                                         debug_command=debug_command,
 		                                         nonewline=nonewline,
-		                                         pause_point_on_fail=pause_point_on_fail)
+		                                         pause_point_on_fail=pause_point_on_fail,
+		                                         timeout=timeout,
+		                                         backoff=backoff,
+		                                         target_loop=target_loop)
 
 
 	def challenge(self,
@@ -504,6 +515,41 @@ class ShutIt(object):
 		                                                     retbool=True)
 
 
+	def send_batch(self,
+	               sends,
+	               shutit_pexpect_child=None,
+	               timeout=None,
+	               exit_values=None,
+	               fail_on_fail=True,
+	               echo=None,
+	               note=None,
+	               loglevel=logging.INFO):
+		"""Send a list of commands in one write, returning the output and exit
+		value of each. The batch stops at the first command that fails.
+
+		@param sends:                List of commands to send.
+		@param shutit_pexpect_child: See send()
+		@param timeout:              Timeout for the whole batch. See send()
+		@param exit_values:          See send()
+		@param fail_on_fail:         Fail if a command returns an unacceptable exit value.
+		@param echo:                 See send()
+		@param note:                 See send()
+
+		@return:                     List of (output, exit value) tuples, one for each
+		                             command that was run.
+		@rtype:                      list
+		"""
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.send_batch(sends,
+		                                         timeout=timeout,
+		                                         exit_values=exit_values,
+		                                         fail_on_fail=fail_on_fail,
+		                                         echo=echo,
+		                                         note=note,
+		                                         loglevel=loglevel)
+
+
 	def handle_note(self, note, command='', training_input=''):
 		"""Handle notes and walkthrough option.
 
@@ -549,39 +595,41 @@ class ShutIt(object):
 	                           timeout,
 	                           iteration_s=1):
 		"""This function allows you to interrupt the run at more or less any
-		point by breaking up the timeout into interactive chunks.
+		point. Rather than waking up periodically, it blocks until there is
+		output to check, CTRL-C is hit, or the timeout passes.
+
+		iteration_s is no longer used, and is retained for compatibility.
 		"""
 		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
-		accum_timeout = 0
 		if isinstance(expect, str):
 			expect = [expect]
 		if timeout < 1:
 			timeout = 1
-		if iteration_s > timeout:
-			iteration_s = timeout - 1
-		if iteration_s < 1:
-			iteration_s = 1
+		deadline = time.time() + timeout
 		timed_out = True
-		while accum_timeout < timeout:
-			res = shutit_pexpect_session.expect(expect, timeout=iteration_s)
-			if res == len(expect):
-				if shutit.build['ctrlc_stop']:
-					timed_out = False
-					shutit.build['ctrlc_stop'] = False
-					break
-				accum_timeout += iteration_s
-			else:
+		while True:
+			# Read whatever is available without blocking, and check for a match.
+			res = shutit_pexpect_session.expect(expect, timeout=0)
+			if res != len(expect):
 				return res
+			if shutit.build['ctrlc_stop']:
+				timed_out = False
+				shutit.build['ctrlc_stop'] = False
+				break
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			shutit_util.wait_for_input(shutit_pexpect_child.child_fd, remaining)
 		if timed_out and not shutit_util.determine_interactive(self):
 			self.log('Command timed out, trying to get terminal back for you', level=logging.DEBUG)
 			self.fail('Timed out and could not recover') # pragma: no cover
 		else:
 			if shutit_util.determine_interactive(self):
 				shutit_pexpect_child.send('\x03')
-				res = shutit_pexpect_child.expect(expect,timeout=1)
+				res = shutit_pexpect_session.expect(expect,timeout=1)
 				if res == len(expect):
 					shutit_pexpect_child.send('\x1a')
-					res = shutit_pexpect_child.expect(expect,timeout=1)
+					res = shutit_pexpect_session.expect(expect,timeout=1)
 					if res == len(expect):
 						self.fail('CTRL-C sent by ShutIt following a timeout, and could not recover') # pragma: no cover
 				shutit_pexpect_session.pause_point('CTRL-C sent by ShutIt following a timeout; the command has been cancelled')
@@ -652,6 +700,43 @@ class ShutIt(object):
 		                                        encoding=encoding)
 
 
+	def send_file_chunked(self,
+	                      path,
+	                      source,
+	                      shutit_pexpect_child=None,
+	                      frame_size=1048576,
+	                      truncate=False,
+	                      user=None,
+	                      group=None,
+	                      note=None,
+	                      loglevel=logging.INFO):
+		"""Streams a file from the host (a path or an open file object) to the
+		passed-in path on the target in compressed, checksummed frames.
+
+		@param path:        Target location of file on target.
+		@param source:      Path of the file on the host, or a file object open for reading.
+		@param shutit_pexpect_child:       See send()
+		@param frame_size:  Maximum number of (compressed) bytes to send in each frame.
+		@param truncate:    If True, replace any existing file at path rather than overwrite it in place.
+		@param user:        Set ownership to this user (default: leave as is)
+		@param group:       Set group to this group (default: leave as is)
+		@param note:        See send()
+
+		@type path:         string
+		@type frame_size:   integer
+		"""
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.send_file_chunked(path,
+		                                                source,
+		                                                frame_size=frame_size,
+		                                                truncate=truncate,
+		                                                user=user,
+		                                                group=group,
+		                                                note=note,
+		                                                loglevel=loglevel)
+
+
 	def chdir(self,
 	          path,
 	          shutit_pexpect_child=None,
@@ -697,12 +782,39 @@ class ShutIt(object):
 		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
 		self.handle_note(note, 'Sending file from host: ' + hostfilepath + ' to target path: ' + path)
 		self.log('Sending file from host: ' + hostfilepath + ' to: ' + path, level=loglevel)
+		# Only the paths that stream the file need to know whether ownership was asked for.
+		owner = (user, group)
 		if user is None:
 			user = shutit_pexpect_session.whoami()
 		if group is None:
 			group = self.whoarewe()
 		# TODO: use gz for both
-		if os.path.isfile(hostfilepath):
+		if os.path.isfile(hostfilepath) and self._use_chunked_send_file(shutit_pexpect_session):
+			send_function = lambda: shutit_pexpect_session.send_file_chunked(path,
+			                                                                 hostfilepath,
+			                                                                 user=owner[0],
+			                                                                 group=owner[1],
+			                                                                 loglevel=loglevel)
+			cache_owner = owner
+		elif os.path.isfile(hostfilepath) and self.build['delivery'] == 'docker' and shutit_pexpect_session.can_send_file_docker_exec():
+			send_function = lambda: shutit_pexpect_session.send_file_docker_exec(path,
+			                                                                     hostfilepath,
+			                                                                     user=user,
+			                                                                     group=group,
+			                                                                     loglevel=loglevel)
+			cache_owner = (user, group)
+		else:
+			send_function = None
+		if send_function is not None:
+			# Files that are streamed do not go through send_file, so use the transfer cache here.
+			shutit_pexpect_session._send_file_cached(path,
+			                                         os.path.getsize(hostfilepath),
+			                                         lambda: shutit_util.get_file_sha256(hostfilepath),
+			                                         send_function,
+			                                         user=cache_owner[0],
+			                                         group=cache_owner[1],
+			                                         loglevel=loglevel)
+		elif os.path.isfile(hostfilepath):
 			shutit_pexpect_session.send_file(path,
 			                                 codecs.open(hostfilepath,mode='rb',encoding='iso-8859-1').read(),
 			                                 user=user,
@@ -722,6 +834,69 @@ class ShutIt(object):
 		return True
 
 
+	def _get_host_dir_delta(self, shutit_pexpect_session, target_dir, hostfilepath, delete):
+		"""Internal function. Compares the checksums of the files under
+		hostfilepath with those under target_dir on the target, fetched in one
+		round trip. Do not use.
+
+		@return: A tuple of the paths (relative to hostfilepath) of the files and
+		         directories that need sending, and of those on the target to
+		         delete (if delete is set). The first is None if the target cannot
+		         checksum files, in which case everything should be sent.
+		"""
+		if shutit_pexpect_session.command_available('sha256sum'):
+			sha_command = 'sha256sum'
+		elif shutit_pexpect_session.command_available('shasum'):
+			sha_command = 'shasum -a 256'
+		else:
+			return None, []
+		# Directories are listed with a 'd' in place of the checksum.
+		output = shutit_pexpect_session.send_and_get_output(' ( command cd ' + shutit_util.shell_quote(target_dir) + ' 2>/dev/null && command find . -type d | command sed "s/^/d  /" && command find . -type f -exec ' + sha_command + ' {} + )',
+		                                                    loglevel=logging.DEBUG)
+		target_manifest = {}
+		for line in output.split('\n'):
+			fields = line.strip('\r').split('  ', 1)
+			# Names that need escaping are marked with a leading backslash - just resend those.
+			if len(fields) == 2 and fields[1].startswith('./') and not fields[0].startswith('\\'):
+				target_manifest[os.path.normpath(fields[1])] = fields[0]
+		members = []
+		host_paths = set(['.'])
+		for root, subfolders, files in os.walk(hostfilepath):
+			subfolders.sort()
+			files.sort()
+			for subfolder in subfolders:
+				rel = os.path.relpath(os.path.join(root, subfolder), hostfilepath)
+				host_paths.add(rel)
+				if target_manifest.get(rel) != 'd':
+					members.append(rel)
+			for fname in files:
+				hostfullfname = os.path.join(root, fname)
+				rel = os.path.relpath(hostfullfname, hostfilepath)
+				host_paths.add(rel)
+				if os.path.islink(hostfullfname) or not os.path.isfile(hostfullfname):
+					# Links and the like are cheap, and are not checksummed on the target.
+					members.append(rel)
+					continue
+				if target_manifest.get(rel) != shutit_util.get_file_sha256(hostfullfname):
+					members.append(rel)
+		deletions = []
+		if delete:
+			for rel in sorted(target_manifest):
+				# Anything under a directory being deleted goes with it.
+				if rel not in host_paths and (os.path.dirname(rel) or '.') in host_paths:
+					deletions.append(rel)
+		return members, deletions
+
+
+	def _use_chunked_send_file(self, shutit_pexpect_session):
+		"""Internal function. Returns True if files can be streamed to the
+		passed-in session with send_file_chunked. Do not use.
+		"""
+		return (self.build['delivery'] in ('bash','dockerfile') and
+		        self.build['chunked_send_file'] and
+		        shutit_pexpect_session._get_chunked_send_commands() is not None)
+
+
 	def send_host_dir(self,
 	                  path,
 	                  hostfilepath,
@@ -730,6 +905,8 @@ class ShutIt(object):
 	                  note=None,
 	                  user=None,
 	                  group=None,
+	                  delta=None,
+	                  delete=False,
 	                  loglevel=logging.DEBUG):
 		"""Send directory and all contents recursively from host machine to
 		given path.  It will automatically make directories on the target.
@@ -741,9 +918,16 @@ class ShutIt(object):
 		@param note:          See send()
 		@param user:          Set ownership to this user (defaults to whoami)
 		@param group:         Set group to this user (defaults to first group in groups)
+		@param delta:         Only send files that are new or have changed on the
+		                      host, by comparing checksums with those on the target.
+		                      Defaults to the delta_send_host_dir build setting.
+		@param delete:        When sending a delta, also delete files on the target
+		                      that are not on the host.
 
 		@type path:          string
 		@type hostfilepath:  string
+		@type delta:         boolean
+		@type delete:        boolean
 		"""
 		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
 		expect = expect or self.get_current_shutit_pexpect_session().default_expect
@@ -760,16 +944,50 @@ class ShutIt(object):
 		# Create gzip of folder
 		#import pdb
 		#pdb.set_trace()
+		if delta is None:
+			delta = self.build['delta_send_host_dir']
 		if shutit_pexpect_session.command_available('tar'):
 			gzipfname = '/tmp/shutit_tar_tmp.tar.gz'
+			arcname = os.path.basename(os.path.normpath(hostfilepath))
+			members, deletions = None, []
+			if delta:
+				members, deletions = self._get_host_dir_delta(shutit_pexpect_session, path + '/' + arcname, hostfilepath, delete)
+			if members == [] and deletions == []:
+				self.log('send_host_dir: ' + path + '/' + arcname + ' is up to date', level=logging.INFO)
+				self.handle_note_after(note=note)
+				return True
+			if deletions:
+				self.log('send_host_dir: deleting ' + str(len(deletions)) + ' files from ' + path + '/' + arcname, level=logging.INFO)
+				shutit_pexpect_session.send(ShutItSendSpec(shutit_pexpect_session,send=' ( command cd ' + shutit_util.shell_quote(path + '/' + arcname) + ' && command rm -rf -- ' + ' '.join([shutit_util.shell_quote(f) for f in deletions]) + ' )',
+				                                           echo=False,
+				                                           loglevel=loglevel))
+			if members == []:
+				self.handle_note_after(note=note)
+				return True
 			with tarfile.open(gzipfname, 'w:gz') as tar:
-				tar.add(hostfilepath, arcname=os.path.basename(hostfilepath))
-			shutit_pexpect_session.send_file(gzipfname,
-			                                 codecs.open(gzipfname,mode='rb',encoding='iso-8859-1').read(),
-			                                 user=user,
-			                                 group=group,
-			                                 loglevel=loglevel,
-			                                 encoding='iso-8859-1')
+				if members is None:
+					tar.add(hostfilepath, arcname=arcname)
+				else:
+					self.log('send_host_dir: sending ' + str(len(members)) + ' new or changed files and directories to ' + path + '/' + arcname, level=logging.INFO)
+					for member in members:
+						tar.add(os.path.join(hostfilepath, member), arcname=os.path.join(arcname, member), recursive=False)
+			if self._use_chunked_send_file(shutit_pexpect_session):
+				shutit_pexpect_session.send_file_chunked(gzipfname,
+				                                         gzipfname,
+				                                         loglevel=loglevel)
+			elif self.build['delivery'] == 'docker' and shutit_pexpect_session.can_send_file_docker_exec():
+				shutit_pexpect_session.send_file_docker_exec(gzipfname,
+				                                             gzipfname,
+				                                             user=user,
+				                                             group=group,
+				                                             loglevel=loglevel)
+			else:
+				shutit_pexpect_session.send_file(gzipfname,
+				                                 codecs.open(gzipfname,mode='rb',encoding='iso-8859-1').read(),
+				                                 user=user,
+				                                 group=group,
+				                                 loglevel=loglevel,
+				                                 encoding='iso-8859-1')
 			shutit_pexpect_session.send(ShutItSendSpec(shutit_pexpect_session,send=' command mkdir -p ' + path + ' && command tar -C ' + path + ' -zxf ' + gzipfname))
 		else:
 			# If no gunzip, fall back to old slow method.
@@ -823,6 +1041,53 @@ class ShutIt(object):
 		return shutit_pexpect_session.file_exists(filename=filename,directory=directory,note=note,loglevel=loglevel)
 
 
+	def file_exists_many(self,
+	                     filenames,
+	                     shutit_pexpect_child=None,
+	                     directory=False,
+	                     note=None,
+	                     loglevel=logging.DEBUG):
+		"""Return a dict mapping each filename to True if it exists on the
+		target host, else False, in one round trip.
+
+		@param filenames:  List of filenames to determine the existence of.
+		@param shutit_pexpect_child:      See send()
+		@param directory:  Indicate that the files should be directories.
+		@param note:       See send()
+
+		@type filenames:   list of strings
+		@type directory:   boolean
+
+		@rtype: dict
+		"""
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.file_exists_many(filenames,directory=directory,note=note,loglevel=loglevel)
+
+
+	def get_file_info_many(self,
+	                       filenames,
+	                       shutit_pexpect_child=None,
+	                       note=None,
+	                       loglevel=logging.DEBUG):
+		"""Returns information (existence, type, permissions, owner, group,
+		size and mtime) about each of a list of files on the target, in one
+		round trip.
+
+		@param filenames:  List of filenames to get information on.
+		@param shutit_pexpect_child:      See send()
+		@param note:       See send()
+
+		@type filenames:   list of strings
+
+		@return: See ShutItPexpectSession.get_file_info_many()
+		@rtype: dict
+		"""
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.get_file_info_many(filenames,note=note,loglevel=loglevel)
+
+
 	def get_file_perms(self,
 	                   filename,
 	                   shutit_pexpect_child=None,
@@ -844,6 +1109,28 @@ class ShutIt(object):
 		return shutit_pexpect_session.get_file_perms(filename,note=note,loglevel=loglevel)
 
 
+	def get_file_perms_many(self,
+	                        filenames,
+	                        shutit_pexpect_child=None,
+	                        note=None,
+	                        loglevel=logging.DEBUG):
+		"""Return a dict mapping each filename to its permissions on the target
+		as an octal string triplet (None if the file does not exist), in one
+		round trip.
+
+		@param filenames:  List of filenames to get permissions of.
+		@param shutit_pexpect_child:     See send()
+		@param note:      See send()
+
+		@type filenames:   list of strings
+
+		@rtype:           dict
+		"""
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.get_file_perms_many(filenames,note=note,loglevel=loglevel)
+
+
 
 	def remove_line_from_file(self,
 	                          line,
@@ -1209,39 +1496,83 @@ class ShutIt(object):
 	def get_file(self,
 	             target_path,
 	             host_path,
+	             shutit_pexpect_child=None,
 	             note=None,
 	             loglevel=logging.DEBUG):
 		"""Copy a file from the target machine to the host machine
 
+		For docker delivery 'docker cp' is used, otherwise the file is
+		streamed back over the session (see get_file_chunked).
+
 		@param target_path: path to file in the target
-		@param host_path:   path to file on the host machine (e.g. copy test)
+		@param host_path:   path to file on the host machine (e.g. copy test),
+		                    or a directory on the host to put it in
+		@param shutit_pexpect_child:       See send()
 		@param note:        See send()
 
 		@type target_path: string
 		@type host_path:   string
 
-		@return:           boolean
-		@rtype:            string
+		@return:           True
+		@rtype:            boolean
 		"""
 		self.handle_note(note)
-		# Only handle for docker initially, return false in case we care
-		if self.build['delivery'] != 'docker':
-			return False
-		# on the host, run:
-		#Usage:  docker cp [OPTIONS] CONTAINER:PATH LOCALPATH|-
-		# Need: host env, container id, path from and path to
-		shutit_pexpect_child     = self.get_shutit_pexpect_session_from_id('host_child').pexpect_child
-		expect    = self.expect_prompts['ORIGIN_ENV']
-		self.send('docker cp ' + self.target['container_id'] + ':' + target_path + ' ' + host_path,
-		          shutit_pexpect_child=shutit_pexpect_child,
-		          expect=expect,
-		          check_exit=False,
-		          echo=False,
-		          loglevel=loglevel)
+		if os.path.isdir(host_path):
+			host_path = os.path.join(host_path, os.path.basename(target_path))
+		if self.build['delivery'] == 'docker':
+			# on the host, run:
+			#Usage:  docker cp [OPTIONS] CONTAINER:PATH LOCALPATH|-
+			# Need: host env, container id, path from and path to
+			host_child = self.get_shutit_pexpect_session_from_id('host_child').pexpect_child
+			expect    = self.expect_prompts['ORIGIN_ENV']
+			self.send('docker cp ' + self.target['container_id'] + ':' + target_path + ' ' + host_path,
+			          shutit_pexpect_child=host_child,
+			          expect=expect,
+			          check_exit=False,
+			          echo=False,
+			          loglevel=loglevel)
+		else:
+			shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+			shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+			shutit_pexpect_session.get_file_chunked(target_path, host_path, loglevel=loglevel)
 		self.handle_note_after(note=note)
 		return True
 
 
+	def get_file_chunked(self,
+	                     target_path,
+	                     host_path,
+	                     shutit_pexpect_child=None,
+	                     frame_size=1048576,
+	                     compress=True,
+	                     note=None,
+	                     loglevel=logging.INFO):
+		"""Streams a file from the target back to a file on the host over the
+		session, in compressed, checksummed frames. An interrupted download is
+		carried on from where it got to.
+
+		@param target_path: Path to file on the target.
+		@param host_path:   Path to write the file to on the host.
+		@param shutit_pexpect_child:       See send()
+		@param frame_size:  Number of bytes of the file to send in each frame.
+		@param compress:    Whether to gzip each frame on the target.
+		@param note:        See send()
+
+		@type target_path:  string
+		@type host_path:    string
+		@type frame_size:   integer
+		@type compress:     boolean
+		"""
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.get_file_chunked(target_path,
+		                                               host_path,
+		                                               frame_size=frame_size,
+		                                               compress=compress,
+		                                               note=note,
+		                                               loglevel=loglevel)
+
+
 	# TODO: should this be in global object?
 	def prompt_cfg(self, msg, sec, name, ispass=False):
 		"""Prompt for a config value, optionally saving it to the user-level
@@ -1430,6 +1761,7 @@ class ShutIt(object):
 	                        echo=None,
 	                        fail_on_empty_before=True,
 	                        nonewline=False,
+	                        base64_frame=False,
 	                        loglevel=logging.DEBUG):
 		"""Returns the output of a command run. send() is called, and exit is not checked.
 
@@ -1440,6 +1772,7 @@ class ShutIt(object):
 		                 and ansi terminal codes
 		@param note:     See send()
 		@param echo:     See send()
+		@param base64_frame: See ShutItPexpectSession.send_and_get_output()
 
 		@type retry:     integer
 		@type strip:     boolean
@@ -1456,9 +1789,37 @@ class ShutIt(object):
 		                                                  echo=echo,
 		                                                  fail_on_empty_before=fail_on_empty_before,
 		                                                  nonewline=nonewline,
+		                                                  base64_frame=base64_frame,
 		                                                  loglevel=loglevel)
 
 
+	def send_and_iter_output(self,
+	                         send,
+	                         shutit_pexpect_child=None,
+	                         timeout=None,
+	                         record_command=True,
+	                         echo=None,
+	                         note=None,
+	                         loglevel=logging.DEBUG):
+		"""Sends a command and returns a generator yielding each line of its
+		output as it arrives, finishing when the prompt is seen.
+
+		@param send:                 See send()
+		@param shutit_pexpect_child: See send()
+		@param timeout:              See send()
+		@param note:                 See send()
+		@param echo:                 See send()
+		"""
+		shutit_pexpect_child = shutit_pexpect_child or self.get_current_shutit_pexpect_session().pexpect_child
+		shutit_pexpect_session = self.get_shutit_pexpect_session_from_child(shutit_pexpect_child)
+		return shutit_pexpect_session.send_and_iter_output(send,
+		                                                   timeout=timeout,
+		                                                   record_command=record_command,
+		                                                   echo=echo,
+		                                                   note=note,
+		                                                   loglevel=loglevel)
+
+
 	def install(self,
 	            package,
 	            shutit_pexpect_child=None,
@@ -1627,6 +1988,37 @@ class ShutIt(object):
 	exit_shell = logout
 
 
+	def park_login(self,
+	               key,
+	               loglevel=logging.DEBUG):
+		"""Suspends the current login's shell instead of logging out, so that it
+		can be resumed later with resume_login(), keeping its environment.
+
+		@param key:             Name to resume the login by.
+
+		@return: True if the shell was parked, False if it was logged out of
+		         instead.
+		"""
+		shutit_pexpect_session = self.get_current_shutit_pexpect_session()
+		return shutit_pexpect_session.park_login(key, loglevel=loglevel)
+
+
+	def resume_login(self,
+	                 key,
+	                 go_home=True,
+	                 loglevel=logging.DEBUG):
+		"""Resumes a login parked with park_login().
+
+		@param key:             Name the login was parked with.
+		@param go_home:         See login()
+
+		@return: True if the login was resumed, False if there is no login
+		         parked with that name.
+		"""
+		shutit_pexpect_session = self.get_current_shutit_pexpect_session()
+		return shutit_pexpect_session.resume_login(key, go_home=go_home, loglevel=loglevel)
+
+
 	def wait(self, cadence=2):
 		shutit_pexpect_session = self.get_current_shutit_pexpect_session()
 		return shutit_pexpect_session.wait(cadence=cadence)
@@ -2023,6 +2415,8 @@ class ShutIt(object):
 						self.fail('Config item: ' + option + ':\nin module:\n[' + module_id + ']\nmust be set!\n\nOften this is a deliberate requirement to place in your ~/.shutit/config file, or you can pass in with:\n\n-s ' + module_id + ' ' + option + ' yourvalue\n\nto the build command', throw_exception=False) # pragma: no cover
 			else:
 				cfg[module_id][option] = default
+		if secret or option in ('password','passphrase'):
+			shutit_global.shutit_global_object.add_secret_word(cfg[module_id][option])
 		return True
 
 
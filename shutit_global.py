@@ -40,6 +40,12 @@ import shutit_setup
 from shutit_module import ShutItFailException
 from shutit_class import ShutIt
 
+PY3 = (sys.version_info[0] >= 3)
+if PY3:
+	string_types = (str,)
+else:
+	string_types = (basestring,)
+
 
 class ShutItGlobal(object):
 	"""Single object to store all the separate ShutIt sessions.
@@ -56,6 +62,8 @@ class ShutItGlobal(object):
 		self.only_one         = True
 
 		self.secret_words_set = set()
+		# Single regexp matching any secret word, built on demand (see redact_secrets).
+		self.secret_words_re  = None
 		self.logfile          = None
 
 
@@ -95,18 +103,43 @@ class ShutItGlobal(object):
 			self.shutit_objects[0].log(shutit_util.colourise(31,'\r\n\r\n' + self.report_final_messages + '\r\n\r\n'), level=logging.INFO, transient=True)
 
 
+	def add_secret_word(self, word):
+		"""Records a secret (eg a password) so that it is never logged or recorded.
+		"""
+		if isinstance(word, string_types) and word != '' and word not in self.secret_words_set:
+			self.secret_words_set.add(word)
+			self.secret_words_re = None
+
+
+	def redact_secrets(self, msg):
+		"""Returns the message with any secret words replaced by 'REDACTED'.
+		"""
+		if not self.secret_words_set:
+			return msg
+		if self.secret_words_re is None:
+			# Longest first, so that a secret containing another is masked in full.
+			words = sorted(self.secret_words_set, key=len, reverse=True)
+			self.secret_words_re = re.compile('|'.join([re.escape(word) for word in words]))
+		return self.secret_words_re.sub('REDACTED', msg)
+
+
 	def log(self, msg, add_final_message=False, level=logging.INFO, transient=False, newline=True, mask_password=True):
 		"""Logging function.
 
+		@param msg:               Message to log, or a callable returning the message.
+		                          A callable is only called if the message is going to
+		                          be logged, so use one for expensive messages.
 		@param add_final_message: Add this log line to the final message output to the user
 		@param level:             Python log level
 		@param transient:         Just write to terminal, no new line. If not a
 		                          terminal, write nothing.
 		"""
+		if not transient and not add_final_message and not logging.getLogger().isEnabledFor(level):
+			return True
+		if callable(msg):
+			msg = msg()
 		if mask_password:
-			for password in shutit_global_object.secret_words_set:
-				if password in msg:
-					msg.replace(password,'REDACTED')
+			msg = self.redact_secrets(msg)
 		if transient:
 			if sys.stdout.isatty():
 				if newline:
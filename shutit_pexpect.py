@@ -26,8 +26,13 @@ try:
 	from md5 import md5
 except ImportError: # pragma: no cover
 	from hashlib import md5
+import atexit
+import gzip
+import hashlib
+import io
 import logging
 import string
+import subprocess
 import time
 import os
 import re
@@ -35,6 +40,7 @@ import base64
 import sys
 import textwrap
 import binascii
+import zlib
 import pexpect
 import shutit_util
 import shutit_assets
@@ -77,6 +83,24 @@ class ShutItPexpectSession(object):
 		self.pexpect_session_id        = pexpect_session_id
 		self.login_stack               = ShutItLoginStack()
 		self.current_environment       = None
+		# Exit code of the last command, as read from the prompt (see setup_prompt).
+		self.last_exit_code            = None
+		# Compiled expect pattern lists, keyed by the tuple of expects passed in.
+		self.expect_cache              = {}
+		self.expect_cache_hits         = 0
+		self.expect_cache_misses       = 0
+		# Optional out-of-band channel from the shell (see setup_control_channel).
+		self.control_channel_path      = None
+		self.control_channel_fd        = None
+		self.last_send_time            = None
+		# Logins suspended by park_login, keyed by the name given.
+		self.parked_logins             = {}
+		# Zero-delay send mode (see _send_to_child).
+		self.delaybeforesend           = delaybeforesend
+		self.zero_delay_send           = False
+		self.at_prompt                 = False
+		self.zero_delay_sends          = 0
+		self.delay_saved_seconds       = 0.0
 		args = args or []
 		self.pexpect_child       = self._spawn_child(command=command,
 		                                             args=args,
@@ -138,13 +162,16 @@ class ShutItPexpectSession(object):
 		"""
 		assert not sendspec.started
 		#self.shutit.log('_sendline: ' + str(sendspec),level=logging.FORENSIC)
+		# Anything that may change the shell or system (eg a package install or su) makes cached facts stale.
+		if self.shutit.build['fact_cache'] and not shutit_util.is_read_only_command(sendspec.send):
+			self.invalidate_facts()
 		if sendspec.force:
 			self.shutit.log('_sendline: forced through, ignoring background and/or run_in_background',level=logging.DEBUG)
 			if sendspec.nonewline != True:
 				sendspec.send += '\n'
 				# sendspec has newline added now, so no need to keep marker
 				sendspec.nonewline = True
-			self.pexpect_child.send(sendspec.send)
+			self._send_to_child(sendspec.send)
 			return False
 		else:
 			# Check there are no background commands running that have block_other_commands set iff
@@ -168,10 +195,31 @@ class ShutItPexpectSession(object):
 				shutit_background_command_object.run_background_command()
 				return True
 			else:
-				self.pexpect_child.send(sendspec.send)
+				self._send_to_child(sendspec.send)
 				return False
 
 
+	def _send_to_child(self, string):
+		"""Internal function. Do not use.
+
+		Writes the string to the child. In zero-delay send mode the
+		delaybeforesend sleep is skipped if the last expect matched the shell's
+		prompt, as the shell is then known to be waiting for input. Otherwise
+		(eg sending a password, or sending before the prompt has been seen) the
+		configured delay is kept.
+		"""
+		if self.zero_delay_send and self.at_prompt and self.delaybeforesend:
+			self.pexpect_child.delaybeforesend = 0
+			self.zero_delay_sends += 1
+			self.delay_saved_seconds += self.delaybeforesend
+		self.at_prompt = False
+		self.last_send_time = time.time()
+		try:
+			self.pexpect_child.send(string)
+		finally:
+			self.pexpect_child.delaybeforesend = self.delaybeforesend
+
+
 	# Multisends must go through send() in shutit global
 	# TODO: Think about logout - must block until backgro
 	def _check_blocked(self, sendspec):
@@ -248,7 +296,7 @@ class ShutItPexpectSession(object):
 		# We don't get the default expect here, as it's either passed in, or a base default regexp.
 		shutit = self.shutit
 		if isinstance(password,str):
-			shutit_global.shutit_global_object.secret_words_set.add(password)
+			shutit_global.shutit_global_object.add_secret_word(password)
 		r_id = shutit_util.random_id()
 		if prompt_prefix is None:
 			prompt_prefix = r_id
@@ -310,17 +358,20 @@ class ShutItPexpectSession(object):
 			# Should not get here as login should not be blocked.
 			assert False
 		shutit.log('Login stack after login: ' + str(self.login_stack),level=logging.DEBUG)
-		# Check exit 'by hand' here to not effect/assume setup prompt.
-		if not self.get_exit_value(shutit):
+		# We may be a different user now. This is done before setting up the
+		# prompt, as that may probe a new environment for its facts.
+		self.invalidate_facts()
+		# Setup prompt, checking the exit code of the login 'by hand' at the
+		# same time, so as not to effect/assume the prompt.
+		if prompt_prefix != None:
+			ok = self.setup_prompt(r_id,prefix=prompt_prefix,check_exit=True)
+		else:
+			ok = self.setup_prompt(r_id,check_exit=True)
+		if not ok:
 			if fail_on_fail: # pragma: no cover
 				shutit.fail('Login failure!')
 			else:
 				return False
-		# Setup prompt
-		if prompt_prefix != None:
-			self.setup_prompt(r_id,prefix=prompt_prefix)
-		else:
-			self.setup_prompt(r_id)
 		if go_home:
 			self.send(ShutItSendSpec(self,send='cd',
 			                         check_exit=False,
@@ -363,14 +414,120 @@ class ShutItPexpectSession(object):
 		                                  loglevel=sendspec.loglevel,
 			                              nonewline=sendspec.nonewline,
 		                                  no_wrap=True)
+		self.invalidate_facts()
 		shutit.handle_note_after(note=sendspec.note)
 		return output
 
 
+	def park_login(self,
+	               key,
+	               loglevel=logging.DEBUG):
+		"""Rather than logging out of the current login (see login()), suspends
+		its shell as a stopped job in the shell below, so that it can be picked
+		up again with resume_login(), keeping its environment.
+
+		If the shell cannot be suspended (eg the shell below does not have job
+		control), it is logged out of instead. A shell that is stopped but not
+		taken over by the shell below is continued again after a few seconds.
+
+		@param key:  Name to resume the login by.
+
+		@return: True if the shell was parked, False if it was logged out of.
+		@rtype: boolean
+		"""
+		shutit = self.shutit
+		self.wait()
+		if self.login_stack.length() == 0:
+			shutit.fail('park_login called without corresponding login', throw_exception=False) # pragma: no cover
+		if key in self.parked_logins:
+			shutit.fail('park_login called with key already parked: ' + key) # pragma: no cover
+		login_expect = self.default_expect
+		login_id = self.login_stack.pop().login_id
+		if self.login_stack.length() > 0:
+			self.default_expect = shutit.expect_prompts[self.login_stack.get_current_login_id()]
+		else:
+			shutit.set_default_shutit_pexpect_session_expect()
+		shutit.log('Parking login: ' + login_id + ' as: ' + key,level=loglevel)
+		# If the shell below has no job control, nothing would ever continue the
+		# stopped shell, so a watchdog continues it after a few seconds, and its
+		# prompt comes back.
+		# The quotes in the middle of the markers are there to prevent the output matching the command.
+		assert not self.sendline(ShutItSendSpec(self,send=' echo SHUTIT_PARK""_PID:$$; ( command sleep 5; command kill -CONT $$ ) >/dev/null 2>&1 & echo SHUTIT_PARK""_WATCHDOG:$!; suspend',ignore_background=True,force=True))
+		res = self.expect([login_expect] + self._get_default_expect_list(), timeout=30)
+		before = self.pexpect_child.before
+		watchdog = shutit_util.match_string(shutit, before, r'^SHUTIT_PARK_WATCHDOG:([0-9]+)')
+		if res > len(self._get_default_expect_list()):
+			shutit.fail('Timed out suspending shell for login: ' + login_id) # pragma: no cover
+		if res == 0:
+			shutit.log('Could not suspend shell for login: ' + login_id + ', logging out instead',level=loglevel)
+			self.login_stack.append(login_id)
+			self.default_expect = login_expect
+		if isinstance(watchdog, str):
+			self.send(ShutItSendSpec(self,send=' command kill ' + watchdog + ' 2>/dev/null',
+			                         check_exit=False,
+			                         echo=False,
+			                         loglevel=loglevel,
+			                         ignore_background=True,force=True))
+		if res == 0:
+			self.logout(ShutItSendSpec(self,send='exit',echo=False,loglevel=loglevel))
+			return False
+		job = shutit_util.match_string(shutit, before, r'^\[([0-9]+)\]\+ +Stopped')
+		if not isinstance(job, str):
+			pid = shutit_util.match_string(shutit, before, r'^SHUTIT_PARK_PID:([0-9]+)')
+			job = shutit_util.match_string(shutit, self.send_and_get_output(' jobs -l',echo=False,loglevel=loglevel), r'^\[([0-9]+)\][+-]? +' + str(pid) + ' ')
+			if not isinstance(job, str):
+				shutit.fail('Could not find job for parked login: ' + login_id) # pragma: no cover
+		self.parked_logins[key] = {'login_id':login_id, 'expect':login_expect, 'job':job}
+		self.invalidate_facts()
+		return True
+
+
+	def resume_login(self,
+	                 key,
+	                 go_home=True,
+	                 loglevel=logging.DEBUG):
+		"""Resumes a login parked with park_login().
+
+		@param key:      Name the login was parked with.
+		@param go_home:  See login()
+
+		@return: True if the login was resumed, False if there is no login
+		         parked with that name.
+		@rtype: boolean
+		"""
+		shutit = self.shutit
+		if key not in self.parked_logins:
+			return False
+		parked = self.parked_logins.pop(key)
+		shutit.log('Resuming login: ' + parked['login_id'] + ' parked as: ' + key,level=loglevel)
+		self.invalidate_facts()
+		assert not self.sendline(ShutItSendSpec(self,send=' fg %' + parked['job'],ignore_background=True,force=True))
+		self.expect(parked['expect'])
+		self.default_expect = parked['expect']
+		self.login_stack.append(parked['login_id'])
+		if go_home:
+			self.send(ShutItSendSpec(self,send=' command cd',
+			                         check_exit=False,
+			                         echo=False,
+			                         ignore_background=True,
+			                         loglevel=loglevel))
+		return True
+
+
+	def logout_parked(self,
+	                  loglevel=logging.DEBUG):
+		"""Resumes and logs out of all the logins parked with park_login().
+		"""
+		for key in list(self.parked_logins.keys()):
+			self.resume_login(key, go_home=False, loglevel=loglevel)
+			self.logout(ShutItSendSpec(self,send='exit',echo=False,loglevel=loglevel))
+
+
 
 	def setup_prompt(self,
 	                 prompt_name,
 	                 prefix='default',
+	                 check_exit=False,
 	                 loglevel=logging.DEBUG):
 		"""Use this when you've opened a new shell to set the PS1 to something
 		sane. By default, it sets up the default expect so you don't have to
@@ -391,11 +548,20 @@ class ShutItPexpectSession(object):
 		This function is assumed to be called whenever there is a change
 		of environment.
 
+		All of the shell setup is done with one command, which also returns
+		the hostname and the environment id (if any) for the new shell.
+
 		@param prompt_name:         Reference name for prompt.
 		@param prefix:              Prompt prefix. Default: 'default'
+		@param check_exit:          If True, only set up the prompt if the last
+		                            command (eg a login) succeeded.
 
 		@type prompt_name:          string
 		@type prefix:               string
+		@type check_exit:           boolean
+
+		@return: False if check_exit was set and the last command failed, else True.
+		@rtype: boolean
 		"""
 		shutit = self.shutit
 		local_prompt = prefix + ':' + shutit_util.random_id() + '# '
@@ -410,41 +576,61 @@ class ShutItPexpectSession(object):
 		# haven't figured out why yet - imiell.
 
 		# Split the local prompt into two parts and separate with quotes to protect against the expect matching the command rather than the output.
+		# If configured, the exit code of the last command is placed on a line
+		# before the prompt, so it can be picked up without a further round trip
+		# (see check_last_exit_values). Only bash expands the \n in PS1, so other
+		# shells are left without it, and the exit code is asked for instead.
+		if shutit.build['exit_code_in_prompt']:
+			exit_code_prefix = """ if [ -n "$BASH_VERSION" ]; then _shutit_x='SHUTIT_EXIT_CODE:$?\\n'; else _shutit_x=; fi;"""
+		else:
+			exit_code_prefix = ' _shutit_x=;'
 		shutit.log('Setting up prompt.', level=logging.DEBUG)
-		self.send(ShutItSendSpec(self,send=""" export SHUTIT_BACKUP_PS1_""" + prompt_name + """=$PS1 && PS1='""" + local_prompt[:2] + "''" + local_prompt[2:] + """' && unset PROMPT_COMMAND && stty cols """ + str(shutit.build['stty_cols']),
-		                         expect=['\r\n' + shutit.expect_prompts[prompt_name]],
-		                         fail_on_empty_before=False,
-		                         echo=False,
-		                         loglevel=loglevel,
-		                         ignore_background=True,force=True))
-		shutit.log('Resetting default expect to: ' + shutit.expect_prompts[prompt_name],level=loglevel)
-		self.default_expect = shutit.expect_prompts[prompt_name]
-		hostname = shutit.send_and_get_output("""if [[ $(echo $SHELL) == '/bin/bash' ]]; then echo $HOSTNAME; elif [[ $(command hostname 2> /dev/null) != '' ]]; then hostname -s; fi""", echo=False)
+		environment_id_dir = shutit.build['shutit_state_dir'] + '/environment_id'
+		# These are best endeavours, they might fail (eg if we are not in bash),
+		# so we do not check whether they succeeded.
+		setup = (' export SHUTIT_BACKUP_PS1_' + prompt_name + '=$PS1; unset PROMPT_COMMAND;' +
+		         ' command stty cols ' + str(shutit.build['stty_cols']) + ';' +
+		         ' command shopt -s checkwinsize 2>/dev/null; command stty sane 2>/dev/null;' +
+		         # Set up history the way shutit likes it.
+		         ' command export HISTCONTROL=$HISTCONTROL:ignoredups:ignorespace;' +
+		         """ _shutit_h=$(if [[ $(echo $SHELL) == '/bin/bash' ]]; then echo $HOSTNAME; elif [[ $(command hostname 2> /dev/null) != '' ]]; then hostname -s; fi);""" +
+		         # Split the local prompt into two parts and separate with quotes to protect against the expect matching the command rather than the output.
+		         exit_code_prefix +
+		         """ PS1="$_shutit_x$_shutit_h"':""" + local_prompt[:2] + "''" + local_prompt[2:] + """';""" +
+		         ' if [ -d ' + environment_id_dir + ' ]; then _shutit_e=$(command ls ' + environment_id_dir + '); else _shutit_e=-; fi;')
+		if check_exit:
+			setup = ' if [ $_shutit_rc = 0 ]; then' + setup + ' fi;'
+		# The quotes in the middle of the marker are there to prevent the output matching the command.
+		init = (' _shutit_rc=$?;' + setup +
+		        ' echo SHUTIT_PROMPT""_INFO:$_shutit_rc"|"$_shutit_h"|"$_shutit_e; unset _shutit_rc _shutit_h _shutit_e _shutit_x')
+		assert not self.sendline(ShutItSendSpec(self,send=init,ignore_background=True,force=True))
+		self.expect(r'SHUTIT_PROMPT_INFO:([0-9]*)\|([^|\r\n]*)\|([^\r\n]*)\r?\n')
+		exit_code, hostname, environment_ids = self.pexpect_child.match.groups()
+		if PY3 and isinstance(exit_code, bytes):
+			exit_code, hostname, environment_ids = exit_code.decode('utf-8'), hostname.decode('utf-8'), environment_ids.decode('utf-8')
+		if check_exit and exit_code != '0':
+			shutit.log('Last command failed with exit code ' + exit_code + ', not setting up prompt.',level=loglevel)
+			# We are still in the same shell, so wait for its prompt.
+			self.expect(self.default_expect)
+			return False
+		hostname = hostname.strip()
 		local_prompt_with_hostname = hostname + ':' + local_prompt
 		shutit.expect_prompts[prompt_name] = local_prompt_with_hostname
+		shutit.log('Resetting default expect to: ' + shutit.expect_prompts[prompt_name],level=loglevel)
 		self.default_expect = shutit.expect_prompts[prompt_name]
-
-		# Split the local prompt into two parts and separate with quotes to protect against the expect matching the command rather than the output.
-		self.send(ShutItSendSpec(self,send=""" PS1='""" + shutit.expect_prompts[prompt_name][:2] + "''" + shutit.expect_prompts[prompt_name][2:] + """'""",
-		                         echo=False,
-		                         loglevel=loglevel,ignore_background=True,force=True))
-
-		# These two lines are required to make the terminal sane. They are best endeavours,
-		# they might fail (eg if we are not in bash) so we keep them separate and do not check whether it succeeded.
-		self.send(ShutItSendSpec(self,send=' command shopt -s checkwinsize',
-		                         check_exit=False,
-		                         echo=False,
-		                         loglevel=loglevel,ignore_background=True, force=True))
-		self.send(ShutItSendSpec(self,send=' command stty sane',
-		                         check_exit=False,
-		                         echo=False,
-		                         loglevel=loglevel,ignore_background=True, force=True))
-		# Set up history the way shutit likes it.
-		self.send(ShutItSendSpec(self,send=' command export HISTCONTROL=$HISTCONTROL:ignoredups:ignorespace',
-		                         echo=False,
-		                         loglevel=loglevel,ignore_background=True,force=True))
+		self.expect(self.default_expect)
+		if environment_ids.strip() == '-':
+			environment_ids = None
+		else:
+			environment_ids = environment_ids.split()
+		if shutit.build['control_channel']:
+			self.setup_control_channel(loglevel=loglevel)
+		# The prompt has now been seen in a sane terminal, so it is safe to stop sleeping before sends made at the prompt.
+		if shutit.build['zero_delay_send'] and not self.zero_delay_send:
+			shutit.log('Enabling zero-delay send mode for session: ' + self.pexpect_session_id,level=loglevel)
+			self.zero_delay_send = True
 		# Ensure environment is set up OK.
-		_ = self.init_pexpect_session_environment(prefix)
+		_ = self.init_pexpect_session_environment(prefix, environment_ids=environment_ids)
 		return True
 
 
@@ -486,20 +672,171 @@ class ShutItPexpectSession(object):
 		"""
 		if isinstance(expect, str):
 			expect = [expect]
+		if searchwindowsize is None:
+			searchwindowsize = self._get_prompt_searchwindowsize(expect)
 		if searchwindowsize != None:
 			old_searchwindowsize = self.pexpect_child.searchwindowsize
 			self.pexpect_child.searchwindowsize = searchwindowsize
 		if maxread != None:
 			old_maxread = self.pexpect_child.maxread
 			self.pexpect_child.maxread = maxread
-		res = self.pexpect_child.expect(expect + [pexpect.TIMEOUT] + [pexpect.EOF], timeout=timeout)
+		res = self.pexpect_child.expect_list(self._get_compiled_expect(expect), timeout=timeout)
 		if searchwindowsize != None:
 			self.pexpect_child.searchwindowsize = old_searchwindowsize
 		if maxread != None:
 			self.pexpect_child.maxread = old_maxread
+		self._extract_prompt_exit_code(res < len(expect))
+		self.at_prompt = res < len(expect) and expect[res] in self._get_default_expect_list()
+		if self.control_channel_fd is not None and res < len(expect):
+			self._read_control_channel()
 		return res
 
 
+	def _get_prompt_searchwindowsize(self, expect):
+		"""Internal function. If every expect passed in is a ShutIt prompt,
+		returns a search window sized from the prompt length, else None. Do not use.
+
+		Without a window pexpect searches the whole of the output gathered so
+		far on every read, which is quadratic on large outputs (cat, dpkg -l,
+		build logs). With one, only the tail is searched and the older output
+		spills into the 'before' stream unsearched. A prompt is only ever looked
+		for at the end of the output, so this does not change what is matched.
+		"""
+		shutit = self.shutit
+		if not shutit.build['bounded_prompt_search']:
+			return None
+		prompts = [p for name, p in shutit.expect_prompts.items() if name != 'base_prompt']
+		for e in expect:
+			if not isinstance(e, str) or e not in prompts:
+				return None
+		# Room for the prompt as echoed (eg with an exit code), and any line noise.
+		return 2 * max([len(e) for e in expect]) + 200
+
+
+	def _get_default_expect_list(self):
+		"""Internal function. Returns the default expect as a list. Do not use.
+		"""
+		if isinstance(self.default_expect, list):
+			return self.default_expect
+		return [self.default_expect]
+
+
+	def _get_compiled_expect(self, expect):
+		"""Internal function to get the compiled pattern list for the passed-in
+		expect list (with TIMEOUT and EOF appended), compiling it only once per
+		session. Do not use.
+		"""
+		key = tuple(expect)
+		compiled = self.expect_cache.get(key)
+		if compiled is None:
+			self.expect_cache_misses += 1
+			# Guard against unbounded growth from one-off expects.
+			if len(self.expect_cache) > 500:
+				self.expect_cache = {}
+			compiled = self.pexpect_child.compile_pattern_list(expect + [pexpect.TIMEOUT] + [pexpect.EOF])
+			self.expect_cache[key] = compiled
+		else:
+			self.expect_cache_hits += 1
+		return compiled
+
+
+	def setup_control_channel(self, loglevel=logging.DEBUG):
+		"""Sets up an out-of-band channel from the current shell back to ShutIt.
+		After each command the shell writes a completion record with the exit
+		code to a FIFO on the host, which is read when the prompt is matched,
+		rather than the exit code being parsed out of the terminal output.
+
+		This only works where the shell can see the host's filesystem (eg a
+		local bash session); elsewhere the channel is not used for that shell.
+
+		@return: True if the channel is in use for the current shell.
+		@rtype:  boolean
+		"""
+		shutit = self.shutit
+		if self.control_channel_path is None:
+			path = '/tmp/shutit_control_' + shutit_util.random_id()
+			os.mkfifo(path, 0o600)
+			# Opening the read end non-blocking means the shell never waits on us.
+			self.control_channel_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+			self.control_channel_path = path
+			atexit.register(self._close_control_channel)
+		path = self.control_channel_path
+		# The quotes before YES are deliberate, to prevent the command from matching the output.
+		if self.send_and_get_output(' test -p ' + path + ' && test -w ' + path + ' && echo Y""ES', echo=False, loglevel=loglevel) != 'YES':
+			shutit.log('Control channel not visible from this shell, not using it.',level=loglevel)
+			return False
+		# <> on a FIFO does not block, even if nothing is reading from it.
+		self.send(ShutItSendSpec(self,send=""" PROMPT_COMMAND='{ echo "SHUTIT_CONTROL:$?" 1<>""" + path + """; } 2>/dev/null'""",
+		                         check_exit=False,
+		                         echo=False,
+		                         loglevel=loglevel,
+		                         ignore_background=True,force=True))
+		# Discard anything written so far.
+		self._read_control_channel()
+		shutit.log('Control channel set up: ' + path,level=loglevel)
+		return True
+
+
+	def _read_control_channel(self):
+		"""Internal function to read any completion records written by the shell
+		to the control channel since the last read, and pick up the exit code
+		from the latest. Do not use.
+		"""
+		data = ''
+		while True:
+			try:
+				chunk = os.read(self.control_channel_fd, 4096)
+			except OSError:
+				break
+			if not chunk:
+				break
+			data += chunk.decode('utf-8','replace')
+		records = re.findall('SHUTIT_CONTROL:([0-9]+)', data)
+		if not records:
+			return
+		self.last_exit_code = records[-1]
+		if self.last_send_time is not None:
+			elapsed = time.time() - self.last_send_time
+		else:
+			elapsed = 0
+		self.shutit.log(lambda: 'Control channel: exit code ' + records[-1] + ', ' + str(len(self.pexpect_child.before)) + ' bytes of output, ' + ('%.3f' % elapsed) + 's',level=logging.DEBUG)
+
+
+	def _close_control_channel(self):
+		"""Internal function to tidy up the control channel on exit. Do not use.
+		"""
+		if self.control_channel_fd is not None:
+			os.close(self.control_channel_fd)
+			self.control_channel_fd = None
+		if self.control_channel_path is not None and os.path.exists(self.control_channel_path):
+			os.remove(self.control_channel_path)
+
+
+	def _extract_prompt_exit_code(self, matched):
+		"""Internal function to pick up the exit code placed in the prompt by
+		setup_prompt, and remove it from the 'before' output so that callers see
+		the command output only. Do not use.
+
+		@param matched:  Whether the last expect matched (ie was not a TIMEOUT or EOF).
+		"""
+		self.last_exit_code = None
+		if not matched or not self.shutit.build['exit_code_in_prompt']:
+			return
+		before = self.pexpect_child.before
+		if not isinstance(before, str):
+			return
+		match = re.search(r'(\r*\n)?(SHUTIT_EXIT_CODE:([0-9][0-9]?[0-9]?))(\r*\n?)$', before)
+		if match is None:
+			return
+		self.last_exit_code = match.group(3)
+		# If the newline after the exit code was consumed by the expect, then so
+		# would the newline before the prompt have been, so remove that too.
+		if '\n' not in match.group(4):
+			self.pexpect_child.before = before[:match.start()]
+		else:
+			self.pexpect_child.before = before[:match.start(2)]
+
+
 	def replace_container(self, new_target_image_name, go_home=None):
 		"""Replaces a container. Assumes we are in Docker context.
 		"""
@@ -546,6 +883,10 @@ class ShutItPexpectSession(object):
 		"""
 		shutit = self.shutit
 		shutit.handle_note(note)
+		found, res = self._get_fact('whoami')
+		if found:
+			shutit.handle_note_after(note=note)
+			return res
 		res = self.send_and_get_output(' command whoami',
 		                               echo=False,
 		                               loglevel=loglevel).strip()
@@ -553,10 +894,47 @@ class ShutItPexpectSession(object):
 			res = self.send_and_get_output(' command id -u -n',
 			                               echo=False,
 			                               loglevel=loglevel).strip()
+		self._set_fact('whoami', res)
 		shutit.handle_note_after(note=note)
 		return res
 
 
+	def _get_fact(self, name, arg=None, ttl=None):
+		"""Internal function. Looks up a fact about the current shell in the
+		current environment's fact cache. Do not use.
+
+		@return: (True, value) if found, else (False, None)
+		"""
+		if not self.shutit.build['fact_cache'] or self.current_environment is None:
+			return False, None
+		found, value = self.current_environment.get_fact((self.pexpect_session_id, name, arg), ttl=ttl)
+		if found:
+			self.shutit.log('Fact cache hit: ' + name + ' ' + str(arg) + ': ' + str(value),level=logging.DEBUG)
+		return found, value
+
+
+	def _set_fact(self, name, value, arg=None):
+		"""Internal function. Stores a fact about the current shell in the
+		current environment's fact cache. Do not use.
+		"""
+		if not self.shutit.build['fact_cache'] or self.current_environment is None:
+			return
+		self.current_environment.set_fact((self.pexpect_session_id, name, arg), value)
+
+
+	def invalidate_facts(self, name=None):
+		"""Forgets cached facts about the current shell (eg whoami), so they
+		are looked up again next time they are needed. Called on login, logout,
+		install and remove, and whenever a command that is not known to be
+		read-only is sent (see shutit_util.is_read_only_command).
+
+		@param name: Only forget this fact (eg 'command_available'). Default: all.
+		"""
+		# The shell may have been in other environments, so clear them all.
+		for environment in self.shutit.shutit_pexpect_session_environments:
+			environment.invalidate_facts(session_id=self.pexpect_session_id, name=name)
+
+
 
 	def check_last_exit_values(self,
 	                           send,
@@ -575,12 +953,17 @@ class ShutItPexpectSession(object):
 			exit_values = ['0']
 		if isinstance(exit_values, int):
 			exit_values = [str(exit_values)]
-		# Don't use send here (will mess up last_output)!
-		# Space before "echo" here is sic - we don't need this to show up in bash history
-		assert not self.sendline(ShutItSendSpec(self,send=' echo EXIT_CODE:$?',ignore_background=True,force=True))
-		shutit.log('Expecting: ' + str(expect),level=logging.DEBUG)
-		self.expect(expect,timeout=60)
-		res = shutit_util.match_string(shutit, str(self.pexpect_child.before), '^EXIT_CODE:([0-9][0-9]?[0-9]?)$')
+		if self.last_exit_code is not None:
+			# The exit code was picked up from the prompt or control channel, so no need to ask for it.
+			res = self.last_exit_code
+			shutit.log('Exit code already received: ' + res,level=logging.DEBUG)
+		else:
+			# Don't use send here (will mess up last_output)!
+			# Space before "echo" here is sic - we don't need this to show up in bash history
+			assert not self.sendline(ShutItSendSpec(self,send=' echo EXIT_CODE:$?',ignore_background=True,force=True))
+			shutit.log('Expecting: ' + str(expect),level=logging.DEBUG)
+			self.expect(expect,timeout=60)
+			res = shutit_util.match_string(shutit, str(self.pexpect_child.before), '^EXIT_CODE:([0-9][0-9]?[0-9]?)$')
 			# Legacy code thought no longer required. Delete when forgotten about.
 			#if res is None and (isinstance(self.pexpect_child.before, pexpect.exceptions.EOF) or isinstance(self.pexpect_child.after, pexpect.exceptions.EOF)):
 			#	shutit_util.handle_exit(1)
@@ -694,6 +1077,13 @@ class ShutItPexpectSession(object):
 					shutit.log('\r\n' + (shutit_util.colourise(colour, msg)),transient=True,level=logging.critical)
 			else:
 				shutit.log(shutit_util.colourise(colour, msg) + '\r\n' + default_msg + '\r\n',transient=True,level=logging.CRITICAL)
+			# The exit code line in the prompt is only for ShutIt, so hide it from the user.
+			if shutit.build['exit_code_in_prompt']:
+				self.send(ShutItSendSpec(self,send=""" _shutit_pp_ps1=$PS1; PS1=${PS1#'SHUTIT_EXIT_CODE:$?\\n'}""",
+				                         echo=False,
+				                         check_exit=False,
+				                         loglevel=logging.DEBUG,
+				                         ignore_background=True,force=True))
 			oldlog = self.pexpect_child.logfile_send
 			self.pexpect_child.logfile_send = None
 			if wait > 0:
@@ -705,6 +1095,12 @@ class ShutItPexpectSession(object):
 				except Exception as e:
 					shutit.fail('Terminating ShutIt within pause point.\r\n' + str(e)) # pragma: no cover
 			self.pexpect_child.logfile_send = oldlog
+			if shutit.build['exit_code_in_prompt']:
+				self.send(ShutItSendSpec(self,send=' PS1=${_shutit_pp_ps1:-$PS1}; unset _shutit_pp_ps1',
+				                         echo=False,
+				                         check_exit=False,
+				                         loglevel=logging.DEBUG,
+				                         ignore_background=True,force=True))
 		else:
 			pass
 		shutit.build['ctrlc_stop'] = False
@@ -766,6 +1162,123 @@ class ShutItPexpectSession(object):
 		return ret
 
 
+	def get_file_info_many(self,
+	                       filenames,
+	                       note=None,
+	                       loglevel=logging.DEBUG):
+		"""Returns information about each of a list of files on the target, in
+		one round trip. Useful for checking many files, or taking a snapshot
+		of the state of a directory tree.
+
+		@param filenames:  List of filenames to get information on.
+		@param note:       See send()
+
+		@type filenames:   list of strings
+
+		@return: dict mapping each filename to a dict with keys:
+		         exists:    boolean, as for file_exists()
+		         directory: boolean, True if it is a directory (or a link to one)
+		         type:      'file', 'directory', 'symlink' or 'other' (None if it does not exist)
+		         perms:     octal permissions string triplet, as for get_file_perms()
+		         owner:     user owning the file
+		         group:     group owning the file
+		         size:      size in bytes (int)
+		         mtime:     modification time in seconds since the epoch (int)
+		         If the file does not exist, all but exists and directory are None.
+		@rtype: dict
+		"""
+		shutit = self.shutit
+		shutit.handle_note(note)
+		ret = {}
+		if not filenames:
+			shutit.handle_note_after(note=note)
+			return ret
+		quoted = ' '.join([shutit_util.shell_quote(f) for f in filenames])
+		# Each file is output on a line as: exists|directory|type|perms|owner|group|size|mtime|index
+		# where index is the file's position in the list, as the name may not come back intact.
+		# The quotes in the middle of the marker are there to prevent the output matching the command.
+		cmd = (' _shutit_n=0; for _shutit_f in ' + quoted + '; do' +
+		       ' _shutit_e=0; _shutit_d=0; _shutit_s="|||||";' +
+		       ' [ -d "$_shutit_f" ] && _shutit_d=1;' +
+		       ' if [ -e "$_shutit_f" ]; then _shutit_e=1;' +
+		       ' if [ -L "$_shutit_f" ]; then _shutit_t=symlink; elif [ -d "$_shutit_f" ]; then _shutit_t=directory; elif [ -f "$_shutit_f" ]; then _shutit_t=file; else _shutit_t=other; fi;' +
+		       ' _shutit_s="$_shutit_t|$(command stat -c \'%a|%U|%G|%s|%Y\' "$_shutit_f" 2>/dev/null || echo \'||||\')"; fi;' +
+		       ' echo "SHUTIT_FILE""_INFO:$_shutit_e|$_shutit_d|$_shutit_s|$_shutit_n"; _shutit_n=$((_shutit_n+1));' +
+		       ' done; unset _shutit_n _shutit_f _shutit_e _shutit_d _shutit_t _shutit_s')
+		output = self.send_and_get_output(cmd,
+		                                  record_command=False,
+		                                  echo=False,
+		                                  loglevel=loglevel)
+		for line in output.replace('\r','').split('\n'):
+			if not line.startswith('SHUTIT_FILE_INFO:'):
+				continue
+			fields = line[len('SHUTIT_FILE_INFO:'):].split('|',8)
+			if len(fields) != 9:
+				shutit.log('Could not parse file info line: ' + line,level=logging.WARNING)
+				continue
+			exists, directory, file_type, perms, owner, group, size, mtime, index = fields
+			if not index.isdigit() or int(index) >= len(filenames):
+				shutit.log('Could not parse file info line: ' + line,level=logging.WARNING)
+				continue
+			info = {'exists':exists == '1', 'directory':directory == '1', 'type':None, 'perms':None, 'owner':None, 'group':None, 'size':None, 'mtime':None}
+			if info['exists']:
+				info['type']  = file_type
+				info['perms'] = shutit_util.match_string(shutit, perms, '([0-9][0-9][0-9])')
+				info['owner'] = owner or None
+				info['group'] = group or None
+				info['size']  = int(size) if size.isdigit() else None
+				info['mtime'] = int(mtime) if mtime.isdigit() else None
+			ret[filenames[int(index)]] = info
+		for filename in filenames:
+			if filename not in ret:
+				shutit.fail('Did not get file info for: ' + filename + ' in output:\n' + output) # pragma: no cover
+		shutit.handle_note_after(note=note)
+		return ret
+
+
+	def file_exists_many(self,
+	                     filenames,
+	                     directory=False,
+	                     note=None,
+	                     loglevel=logging.DEBUG):
+		"""Return a dict mapping each filename to True if it exists on the
+		target host, else False. See file_exists(); this takes one round trip
+		however many files there are.
+
+		@param filenames:  List of filenames to determine the existence of.
+		@param directory:  Indicate that the files should be directories.
+		@param note:       See send()
+
+		@type filenames:   list of strings
+		@type directory:   boolean
+
+		@rtype: dict
+		"""
+		info = self.get_file_info_many(filenames, note=note, loglevel=loglevel)
+		if directory is True:
+			return dict([(f, info[f]['directory']) for f in info])
+		return dict([(f, info[f]['exists']) for f in info])
+
+
+	def get_file_perms_many(self,
+	                        filenames,
+	                        note=None,
+	                        loglevel=logging.DEBUG):
+		"""Return a dict mapping each filename to its permissions on the target
+		as an octal string triplet (None if the file does not exist). See
+		get_file_perms(); this takes one round trip however many files there are.
+
+		@param filenames:  List of filenames to get permissions of.
+		@param note:       See send()
+
+		@type filenames:   list of strings
+
+		@rtype: dict
+		"""
+		info = self.get_file_info_many(filenames, note=note, loglevel=loglevel)
+		return dict([(f, info[f]['perms']) for f in info])
+
+
 	def chdir(self,
 	          path,
 	          timeout=3600,
@@ -892,7 +1405,7 @@ class ShutItPexpectSession(object):
 		shutit = self.shutit
 		shutit.handle_note(note)
 		if isinstance(password, str):
-			shutit_global.shutit_global_object.secret_words_set.add(password)
+			shutit_global.shutit_global_object.add_secret_word(password)
 		self.install('passwd')
 		if self.current_environment.install_type == 'apt':
 			self.send(ShutItSendSpec(self,send='passwd ' + user,
@@ -945,22 +1458,40 @@ class ShutItPexpectSession(object):
 	                loglevel=logging.DEBUG):
 		"""Get distro information from lsb_release.
 		"""
+		found, d = self._get_fact('lsb_release')
+		if found:
+			return dict(d)
+		d = self._lsb_release(loglevel=loglevel)
+		self._set_fact('lsb_release', dict(d))
+		return d
+
+
+	def _lsb_release(self,
+	                 loglevel=logging.DEBUG):
+		"""Internal function. Do not use.
+		"""
 		#          v the space is intentional, to avoid polluting bash history.
-		shutit = self.shutit
-		d = {}
 		self.send(ShutItSendSpec(self,send=' command lsb_release -a',
 		                         check_exit=False,
 		                         echo=False,
 		                         loglevel=loglevel,
 		                         ignore_background=True,force=True))
-		res = shutit_util.match_string(shutit, self.pexpect_child.before, r'^Distributor[\s]*ID:[\s]*(.*)$')
+		return self._parse_lsb_release(self.pexpect_child.before)
+
+
+	def _parse_lsb_release(self, output):
+		"""Internal function. Parses the output of 'lsb_release -a'. Do not use.
+		"""
+		shutit = self.shutit
+		d = {}
+		res = shutit_util.match_string(shutit, output, r'^Distributor[\s]*ID:[\s]*(.*)$')
 		if isinstance(res, str):
 			dist_string = res
 			d['distro']       = dist_string.lower().strip()
 			d['install_type'] = (package_map.INSTALL_TYPE_MAP[dist_string.lower()])
 		else:
 			return d
-		res = shutit_util.match_string(shutit, self.pexpect_child.before, r'^Release:[\s*](.*)$')
+		res = shutit_util.match_string(shutit, output, r'^Release:[\s*](.*)$')
 		if isinstance(res, str):
 			version_string = res
 			d['distro_version'] = version_string
@@ -1117,11 +1648,16 @@ class ShutItPexpectSession(object):
 	                      loglevel=logging.DEBUG):
 		shutit = self.shutit
 		shutit.handle_note(note)
+		found, res = self._get_fact('command_available', arg=command)
+		if found:
+			return res
 		output = self.send_and_get_output(' command -V ' + command + ' > /dev/null',
 		                                  echo=False,
 		                                  loglevel=loglevel,
 		                                  check_sudo=False).strip()
-		return output == ''
+		res = output == ''
+		self._set_fact('command_available', res, arg=command)
+		return res
 
 
 	def is_shutit_installed(self,
@@ -1354,6 +1890,7 @@ class ShutItPexpectSession(object):
 			shutit.log('Package not required.',level=logging.DEBUG)
 
 		shutit.log('Package is installed.',level=logging.DEBUG)
+		self.invalidate_facts(name='command_available')
 		# Sometimes we see installs (eg yum) reset the terminal to a state
 		# ShutIt does not like.
 		self.reset_terminal()
@@ -1480,6 +2017,7 @@ class ShutItPexpectSession(object):
 			          timeout=timeout,
 			          exit_values=['0','100'],
 			          ignore_background=True,force=True))
+		self.invalidate_facts(name='command_available')
 		shutit.handle_note_after(note=note)
 		return True
 
@@ -1541,18 +2079,24 @@ class ShutItPexpectSession(object):
 	                        no_wrap=None,
 	                        check_sudo=True,
 	                        nonewline=False,
+	                        base64_frame=False,
 	                        loglevel=logging.DEBUG):
 		"""Returns the output of a command run. send() is called, and exit is not checked.
 
-		@param send:     See send()
-		@param retry:    Number of times to retry command (default 3)
-		@param strip:    Whether to strip output (defaults to True). Strips whitespace
-		                 and ansi terminal codes
-		@param note:     See send()
-		@param echo:     See send()
-
-		@type retry:     integer
-		@type strip:     boolean
+		@param send:         See send()
+		@param retry:        Number of times to retry command (default 3)
+		@param strip:        Whether to strip output (defaults to True). Strips whitespace
+		                     and ansi terminal codes
+		@param note:         See send()
+		@param echo:         See send()
+		@param no_wrap:      If not True, commands over 80 characters have their output
+		                     framed with markers to avoid problems with terminal wrap.
+		@param base64_frame: If the output is framed (see no_wrap), base64 it on the
+		                     target so that it passes through the terminal untouched.
+
+		@type retry:         integer
+		@type strip:         boolean
+		@type base64_frame:  boolean
 		"""
 		shutit = self.shutit
 		shutit.handle_note(note, command=str(send))
@@ -1560,11 +2104,24 @@ class ShutItPexpectSession(object):
 		# Don't check exit, as that will pollute the output. Also, it's quite likely the submitted command is intended to fail.
 		echo = shutit.get_echo_override(echo)
 		if no_wrap != True and len(send) > 80:
-			tmpfile = '/tmp/shutit_tmpfile_' + shutit_util.random_id()
-			# To avoid issues with terminal wrap, subshell the command and place
-			# the output in a file.
-			send = ' (' + send + ') > ' + tmpfile + ' 2>&1'
-			self.send(ShutItSendSpec(self,send=shutit_util.get_send_command(shutit, send),
+			# To avoid issues with terminal wrap, subshell the command and frame
+			# the output with markers, so we can pick it out regardless of what
+			# the echoed command looks like.
+			# The quotes in the middle of the markers are there to prevent the output matching the command.
+			random_id = shutit_util.random_id()
+			begin_marker = 'SHUTIT_OUTPUT_BEGIN_' + random_id
+			end_marker   = 'SHUTIT_OUTPUT_END_' + random_id
+			command = shutit_util.get_send_command(shutit, send)
+			if len(command) + 100 > shutit.build['stty_cols']:
+				# Too long to send as-is, so put it in a file first.
+				fname = self._create_command_file(self.default_expect, command)
+				command = ' command source ' + fname + '; rm -f ' + fname
+			if base64_frame:
+				framed_send = ' (' + command + ') 2>&1 | command base64'
+			else:
+				framed_send = ' (' + command + ') 2>&1'
+			framed_send = """ echo '""" + begin_marker[:6] + """''""" + begin_marker[6:] + """';""" + framed_send + """; echo '""" + end_marker[:6] + """''""" + end_marker[6:] + """'"""
+			self.send(ShutItSendSpec(self,send=framed_send,
 			          check_exit=False,
 			          retry=retry,
 			          echo=echo,
@@ -1574,39 +2131,16 @@ class ShutItPexpectSession(object):
 			          fail_on_empty_before=fail_on_empty_before,
 			          loglevel=loglevel,
 			          ignore_background=True,force=True))
-			# Now try an alias
-			send       = ' alias shutitalias=" command cat ' + tmpfile + '"'
-			self.send(ShutItSendSpec(self,send=send,
-			          check_exit=False,
-			          echo=echo,
-			          timeout=timeout,
-			          record_command=record_command,
-			          check_sudo=check_sudo,
-			          loglevel=loglevel,
-			          ignore_background=True,force=True))
-			res = self.send_and_get_output(' shutitalias',
-			                               timeout=timeout,
-			                               strip=strip,
-			                               preserve_newline=preserve_newline,
-			                               note=note,
-			                               record_command=record_command,
-			                               echo=echo,
-			                               fail_on_empty_before=fail_on_empty_before,
-			                               no_wrap=True,
-			                               check_sudo=check_sudo,
-			                               nonewline=nonewline,
-			                               loglevel=loglevel)
-			self.send(ShutItSendSpec(self,
-			                         send=' unalias shutitalias',
-			                         check_exit=False,
-			                         echo=echo,
-			                         timeout=timeout,
-			                         record_command=record_command,
-			                         check_sudo=check_sudo,
-			                         nonewline=nonewline,
-			                         loglevel=loglevel,
-			                         ignore_background=True,force=True))
-			return res
+			before = self.pexpect_child.before
+			match = re.search(begin_marker + r'\r?\n(.*?)' + end_marker, before, re.DOTALL)
+			if match is not None:
+				before = match.group(1)
+				if base64_frame:
+					before = base64.b64decode(''.join(before.split())).decode('utf-8','replace')
+				# Nothing to remove from the output, as the command is outside the markers.
+				send = ''
+			else:
+				shutit.log('Could not find output markers, returning all output',level=logging.WARNING)
 		else:
 			send = shutit_util.get_send_command(shutit, send)
 			self.send(ShutItSendSpec(self,send=send,
@@ -1625,7 +2159,8 @@ class ShutItPexpectSession(object):
 		if len(before):
 			preserve_newline = bool(preserve_newline and before[-1] == '\n')
 		# Remove the command we ran in from the output.
-		before = before.strip(send)
+		if send != '':
+			before = before.strip(send)
 		shutit.handle_note_after(note=note)
 		if strip:
 			# cf: http://stackoverflow.com/questions/14693701/how-can-i-remove-the-ansi-escape-sequences-from-a-string-in-python
@@ -1645,6 +2180,80 @@ class ShutItPexpectSession(object):
 		return ret
 
 
+	def send_and_iter_output(self,
+	                         send,
+	                         timeout=None,
+	                         record_command=True,
+	                         echo=None,
+	                         note=None,
+	                         loglevel=logging.DEBUG):
+		"""Generator that sends a command and yields each line of its output
+		(without line endings or ansi terminal codes) as it arrives, finishing
+		when the prompt is seen. Exit is not checked.
+
+		If the caller stops iterating before the command finishes, the command
+		is interrupted with CTRL-C and the session brought back to the prompt.
+
+		@param send:     See send()
+		@param timeout:  Timeout for the whole command. See send()
+		@param note:     See send()
+		@param echo:     See send()
+		"""
+		shutit = self.shutit
+		shutit.handle_note(note, command=str(send))
+		shutit.log('Iterating over output from command: ' + send,level=loglevel)
+		echo = shutit.get_echo_override(echo)
+		if timeout is None:
+			timeout = 3600
+		expect = self.default_expect
+		if isinstance(expect, str):
+			expect = [expect]
+		send = shutit_util.get_send_command(shutit, send)
+		if record_command and send not in shutit_global.shutit_global_object.secret_words_set:
+			shutit.build['shutit_command_history'].append(send)
+		if len(send) + 25 > shutit.build['stty_cols']:
+			fname = self._create_command_file(expect, send)
+			send = ' command source ' + fname + '; rm -f ' + fname
+		ansi_escape = re.compile(r'(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]')
+		# The prompt(s) go first, so they win over the newline if both are seen.
+		expect_list = expect + ['\r?\n']
+		if echo:
+			shutit.divert_output(sys.stdout)
+		assert not self.sendline(ShutItSendSpec(self,send=send,ignore_background=True,force=True))
+		deadline = time.time() + timeout
+		seen_echo = False
+		finished = False
+		try:
+			while True:
+				res = self.expect(expect_list, timeout=max(deadline - time.time(), 0))
+				line = ansi_escape.sub('', self.pexpect_child.before).replace('\r','')
+				if res == len(expect):
+					# Newline seen. The first line is the command we sent, so skip it.
+					if not seen_echo:
+						seen_echo = True
+						continue
+					if self.last_exit_code is not None:
+						# This was the exit code line before the prompt (see setup_prompt).
+						continue
+					yield line
+				elif res < len(expect):
+					finished = True
+					if seen_echo and line != '':
+						yield line
+					break
+				else:
+					shutit.fail('Timed out or EOF seen while waiting for output of: ' + send, shutit_pexpect_child=self.pexpect_child) # pragma: no cover
+		finally:
+			if echo:
+				shutit.divert_output(None)
+			if not finished:
+				# The caller stopped early, so interrupt the command and sync with the prompt.
+				shutit.log('Stopped iterating before the command finished, interrupting: ' + send,level=logging.DEBUG)
+				self.pexpect_child.send('\x03')
+				self.expect(expect, timeout=30)
+			shutit.handle_note_after(note=note)
+
+
 	def get_env_pass(self,user=None,msg=None,note=None):
 		"""Gets a password from the user if one is not already recorded for this environment.
 
@@ -1662,7 +2271,7 @@ class ShutItPexpectSession(object):
 		if not self.current_environment.users[user] and user != 'root':
 			msg = msg or 'Please input the sudo password for user: ' + user
 			self.current_environment.users[user] = shutit_util.get_input(shutit, msg,ispass=True)
-			shutit_global.shutit_global_object.secret_words_set.add(self.current_environment.users[user])
+			shutit_global.shutit_global_object.add_secret_word(self.current_environment.users[user])
 		return self.current_environment.users[user]
 
 
@@ -1678,13 +2287,88 @@ class ShutItPexpectSession(object):
 		"""
 		shutit = self.shutit
 		shutit.handle_note(note)
+		found, res = self._get_fact('whoarewe')
+		if found:
+			shutit.handle_note_after(note=note)
+			return res
 		res = self.send_and_get_output(' command id -n -g',
 		                               echo=False,
 		                               loglevel=loglevel).strip()
+		self._set_fact('whoarewe', res)
 		shutit.handle_note_after(note=note)
 		return res
 
 
+	def probe_environment(self, loglevel=logging.DEBUG):
+		"""Gathers the facts needed to set up an environment in one round trip,
+		and seeds the fact cache (see whoami, command_available etc) with them.
+
+		@return: dict of the facts found, with keys:
+		         lsb_release, issue, os_release, redhat_release: output, or '' if not there
+		         uname, shell, whoami, whoarewe:                 strings
+		         cygdrive, sudo_ok, in_screen:                   booleans
+		         commands:                                       list of the available commands
+		                                                         out of those probed for
+		         brew_list:                                      list of installed brew packages (osx only)
+		@rtype: dict
+		"""
+		shutit = self.shutit
+		probe_commands = ('lsb_release','brew','sudo','apt-get','yum','apk','pacman','emerge','docker','base64','gunzip','md5sum','head')
+		# Each fact is output on a line as: name:value
+		probe = (' for _shutit_c in ' + ' '.join(probe_commands) + '; do command -v $_shutit_c >/dev/null 2>&1 && echo "command:$_shutit_c"; done; unset _shutit_c;' +
+		         ' command -v lsb_release >/dev/null 2>&1 && command lsb_release -a 2>/dev/null | command sed "s/^/lsb_release:/";' +
+		         ' [ -f /etc/issue ] && command sed "s/^/issue:/" /etc/issue;' +
+		         ' [ -f /etc/os-release ] && command grep ^NAME /etc/os-release | command sed "s/^/os_release:/";' +
+		         ' [ -f /etc/redhat-release ] && command sed "s/^/redhat_release:/" /etc/redhat-release;' +
+		         ' [ -d /cygdrive ] && echo cygdrive:1;' +
+		         ' echo "uname:$(command uname -a 2>/dev/null)";' +
+		         ' echo "shell:$SHELL";' +
+		         ' echo "whoami:$(command whoami 2>/dev/null || command id -u -n 2>/dev/null)";' +
+		         ' echo "whoarewe:$(command id -n -g 2>/dev/null)";' +
+		         ' { [ -n "$TMUX" ] || [ "$TERM" = screen ]; } && echo in_screen:1;' +
+		         ' command -v sudo >/dev/null 2>&1 && command sudo -n true 2>/dev/null && echo sudo_ok:1;' +
+		         ' [ "$(command uname 2>/dev/null)" = Darwin ] && command -v brew >/dev/null 2>&1 && command brew list 2>/dev/null | command sed "s/^/brew_list:/";' +
+		         ' true')
+		output = self.send_and_get_output(probe,
+		                                  echo=False,
+		                                  record_command=False,
+		                                  loglevel=loglevel)
+		facts = {'lsb_release':[], 'issue':[], 'os_release':[], 'redhat_release':[], 'commands':[], 'brew_list':[]}
+		for line in output.replace('\r','').split('\n'):
+			if line.find(':') == -1:
+				continue
+			name, value = line.split(':',1)
+			if name == 'command':
+				facts['commands'].append(value)
+			elif name in ('brew_list',):
+				facts[name].extend(value.split())
+			elif name in ('lsb_release','issue','os_release','redhat_release'):
+				facts[name].append(value)
+			elif name in ('uname','shell','whoami','whoarewe'):
+				facts[name] = value.strip()
+			elif name in ('cygdrive','sudo_ok','in_screen'):
+				facts[name] = True
+		for name in ('lsb_release','issue','os_release','redhat_release'):
+			facts[name] = '\n'.join(facts[name])
+		for name in ('uname','shell','whoami','whoarewe'):
+			facts.setdefault(name, '')
+		for name in ('cygdrive','sudo_ok','in_screen'):
+			facts.setdefault(name, False)
+		shutit.log('Environment probe found: ' + str(facts),level=logging.DEBUG)
+		# Seed the fact cache.
+		for command in probe_commands:
+			self._set_fact('command_available', command in facts['commands'], arg=command)
+		if facts['whoami'] != '':
+			self._set_fact('whoami', facts['whoami'])
+		if facts['whoarewe'] != '':
+			self._set_fact('whoarewe', facts['whoarewe'])
+		self._set_fact('check_sudo', facts['sudo_ok'])
+		self._set_fact('in_screen', facts['in_screen'])
+		if facts['lsb_release'] != '':
+			self._set_fact('lsb_release', self._parse_lsb_release(facts['lsb_release']))
+		return facts
+
+
 	def get_distro_info(self, loglevel=logging.DEBUG):
 		"""Get information about which distro we are using, placing it in the environment object.
 
@@ -1701,6 +2385,10 @@ class ShutItPexpectSession(object):
 		install_type   = ''
 		distro         = ''
 		distro_version = ''
+		# Get the facts we need up front, so that the checks below are mostly
+		# lookups. If the distro is given, it is not looked for.
+		if shutit.build['distro_override'] == '':
+			probe = self.probe_environment(loglevel=loglevel)
 		if shutit.build['distro_override'] != '':
 			key = shutit.build['distro_override']
 			distro = shutit.build['distro_override']
@@ -1762,23 +2450,19 @@ class ShutItPexpectSession(object):
 			distro         = d['distro']
 			distro_version = d['distro_version']
 		else:
-			issue_output = self.send_and_get_output(' command cat /etc/issue',
-			                                        echo=False,
-			                                        loglevel=loglevel).lower()
-			if not re.match('.*No such file.*',issue_output):
+			issue_output = probe['issue'].lower()
+			if issue_output != '':
 				for key in package_map.INSTALL_TYPE_MAP.keys():
 					if issue_output.find(key) != -1:
 						distro       = key
 						install_type = package_map.INSTALL_TYPE_MAP[key]
 						break
-			elif self.file_exists('/cygdrive'):
+			elif probe['cygdrive']:
 				distro       = 'cygwin'
 				install_type = 'apt-cyg'
 			if install_type == '' or distro == '':
-				if self.file_exists('/etc/os-release'):
-					os_name = self.send_and_get_output(' command cat /etc/os-release | grep ^NAME',
-					                                   echo=False,
-					                                   loglevel=loglevel).lower()
+				if probe['os_release'] != '':
+					os_name = probe['os_release'].lower()
 					if os_name.find('centos') != -1:
 						distro       = 'centos'
 						install_type = 'yum'
@@ -1796,22 +2480,15 @@ class ShutItPexpectSession(object):
 						distro       = 'coreos'
 						install_type = 'docker'
 				else:
-					uname_output = self.send_and_get_output(" command uname -a | awk '{print $1}'",
-					                                        echo=False,
-					                                        loglevel=loglevel)
+					uname_output = probe['uname'].split(' ')[0]
 					if uname_output == 'Darwin':
 						distro = 'osx'
 						install_type = 'brew'
 						if not self.command_available('brew'):
 							shutit.fail('ShutiIt requires brew be installed. See http://brew.sh for details on installation.') # pragma: no cover
-						if not self.file_exists('/tmp/shutit_brew_list'):
-							self.send(ShutItSendSpec(self,send='brew list > .shutit_brew_list',echo=False,ignore_background=True,force=True))
 						for package in ('coreutils','findutils','gnu-tar','gnu-sed','gawk','gnutls','gnu-indent','gnu-getopt'):
-							if self.send_and_get_output(' command cat .shutit_brew_list | grep -w ' + package,
-							                            echo=False,
-							                            loglevel=loglevel) == '':
+							if package not in probe['brew_list']:
 								self.send(ShutItSendSpec(self,send='brew install ' + package,loglevel=loglevel,ignore_background=True,force=True))
-						self.send(ShutItSendSpec(self,send='rm -f .shutit_brew_list',echo=False,ignore_background=True,force=True))
 					if uname_output[:6] == 'CYGWIN':
 						distro       = 'cygwin'
 						install_type = 'apt-cyg'
@@ -1831,10 +2508,8 @@ class ShutItPexpectSession(object):
 				distro         = d['distro']
 				distro_version = d['distro_version']
 			elif install_type == 'yum' and shutit.build['delivery'] in ('docker','dockerfile'):
-				if self.file_exists('/etc/redhat-release'):
-					output = self.send_and_get_output(' command cat /etc/redhat-release',
-					                                  echo=False,
-					                                  loglevel=loglevel)
+				if probe['redhat_release'] != '':
+					output = probe['redhat_release']
 					if re.match('^centos.*$', output.lower()) or re.match('^red hat.*$', output.lower()) or re.match('^fedora.*$', output.lower()) or True:
 						self.send_and_match_output('yum install -y -t redhat-lsb epel-release',
 						                           'Complete!',
@@ -1974,12 +2649,104 @@ class ShutItPexpectSession(object):
 		return res
 
 
+	def send_batch(self,
+	               sends,
+	               timeout=None,
+	               exit_values=None,
+	               fail_on_fail=True,
+	               echo=None,
+	               note=None,
+	               loglevel=logging.INFO):
+		"""Sends a list of commands to the target in one write, rather than
+		waiting for the prompt after each one. The commands are run in turn in
+		the current shell, and the batch stops at the first command that returns
+		an unacceptable exit value.
+
+		@param sends:                List of commands to send.
+		@param timeout:              Timeout for the whole batch. See send()
+		@param exit_values:          See send(). Applies to each command.
+		@param fail_on_fail:         Fail if a command returns an unacceptable exit
+		                             value (default True). If False, the results up
+		                             to and including that command are returned.
+		@param echo:                 See send()
+		@param note:                 See send()
+
+		@return:                     List of (output, exit value) tuples, one for each
+		                             command that was run.
+		@rtype:                      list
+		"""
+		shutit = self.shutit
+		if isinstance(sends, str):
+			sends = [sends]
+		shutit.handle_note(note, command='\n'.join(sends))
+		if timeout is None:
+			timeout = 3600
+		if exit_values is None:
+			exit_values = ['0']
+		elif isinstance(exit_values, int):
+			exit_values = [str(exit_values)]
+		exit_values = [str(exit_value) for exit_value in exit_values]
+		echo = shutit.get_echo_override(echo)
+		random_id = shutit_util.random_id()
+		begin_marker = 'SHUTIT_BATCH_BEGIN_' + random_id
+		end_marker   = 'SHUTIT_BATCH_END_' + random_id
+		# The whole batch is wrapped in a loop so that we can break out at the first failure.
+		# The quotes in the middle of the markers are there to prevent the output matching the command.
+		script = ' while true; do\n'
+		for i, send in enumerate(sends):
+			script += """ echo '""" + begin_marker[:6] + """''""" + begin_marker[6:] + ':' + str(i) + """'\n"""
+			script += send + '\n'
+			script += ' _shutit_batch_rc=$?\n'
+			script += """ echo '""" + end_marker[:6] + """''""" + end_marker[6:] + ':' + str(i) + """:'$_shutit_batch_rc\n"""
+			script += ' case $_shutit_batch_rc in ' + '|'.join(exit_values) + ') ;; *) break ;; esac\n'
+		script += ' break\ndone'
+		shutit.log('Sending batch of ' + str(len(sends)) + ' commands: ' + str(sends),level=loglevel)
+		for send in sends:
+			if send not in shutit_global.shutit_global_object.secret_words_set:
+				shutit.build['shutit_command_history'].append(send)
+		# Long lines are subject to terminal wrap, so fall back to a command file.
+		fname = None
+		if max([len(line) for line in script.split('\n')]) + 25 > shutit.build['stty_cols']:
+			fname = self._create_command_file(self.default_expect, script)
+			script = ' command source ' + fname + '; rm -f ' + fname
+		if echo:
+			shutit.divert_output(sys.stdout)
+		assert not self.sendline(ShutItSendSpec(self,send=script,ignore_background=True,force=True))
+		shutit.expect_allow_interrupt(shutit, self.pexpect_child, self.default_expect, timeout)
+		if echo:
+			shutit.divert_output(None)
+		before = self.pexpect_child.before
+		ansi_escape = re.compile(r'(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]')
+		results = []
+		for match in re.finditer(begin_marker + r':([0-9]+)\r?\n(.*?)' + end_marker + r':\1:([0-9]+)', before, re.DOTALL):
+			output = ansi_escape.sub('', match.group(2).strip()).replace('\r','')
+			results.append((output, match.group(3)))
+		if results:
+			shutit.build['last_output'] = results[-1][0]
+		for i, (_, exit_value) in enumerate(results):
+			if exit_value not in exit_values:
+				msg = ('\nWARNING: command in batch:\n' + sends[i] + '\nreturned unaccepted exit code: ' + exit_value + '\nIf this is expected, pass in fail_on_fail=False or an exit_values array into the send_batch call.')
+				shutit.build['report'] += msg
+				if fail_on_fail:
+					shutit.fail(msg, shutit_pexpect_child=self.pexpect_child) # pragma: no cover
+				break
+		else:
+			if len(results) != len(sends):
+				msg = 'Only ' + str(len(results)) + ' of ' + str(len(sends)) + ' commands in batch reported back.'
+				shutit.log(msg,level=logging.WARNING)
+				if fail_on_fail:
+					shutit.fail(msg, shutit_pexpect_child=self.pexpect_child) # pragma: no cover
+		shutit.handle_note_after(note=note)
+		return results
+
+
 	def send_and_require(self,
 	                     send,
 	                     regexps,
 	                     not_there=False,
 	                     echo=None,
 	                     note=None,
+	                     target_loop=False,
 	                     loglevel=logging.INFO):
 		"""Send string and require the item in the output.
 		See send_until
@@ -1993,6 +2760,7 @@ class ShutItPexpectSession(object):
 		                       retries=1,
 		                       echo=echo,
 		                       note=note,
+		                       target_loop=target_loop,
 		                       loglevel=loglevel)
 
 
@@ -2007,6 +2775,9 @@ class ShutItPexpectSession(object):
 	               debug_command=None,
 	               pause_point_on_fail=True,
 	               nonewline=False,
+	               timeout=None,
+	               backoff=1,
+	               target_loop=False,
 	               loglevel=logging.INFO):
 		"""Send string on a regular cadence until a string is either seen, or the timeout is triggered.
 
@@ -2014,8 +2785,16 @@ class ShutItPexpectSession(object):
 		@param regexps:              List of regexps to wait for.
 		@param not_there:            If True, wait until this a regexp is not seen in the output. If False
 		                             wait until a regexp is seen in the output (default)
+		@param cadence:              Seconds to wait between attempts.
+		@param retries:              Maximum number of attempts.
 		@param echo:                 See send()
 		@param note:                 See send()
+		@param timeout:              If set, give up after this many seconds.
+		@param backoff:              Multiply the cadence by this after each attempt (default 1).
+		@param target_loop:          If True, run the whole loop on the target and wait
+		                             for it once, rather than sending the command for each
+		                             attempt. The regexps are then tested with 'grep -E', so
+		                             must be valid extended regular expressions.
 		"""
 		shutit = self.shutit
 		shutit.handle_note(note, command=send + ' \nuntil one of these seen:\n' + str(regexps))
@@ -2024,6 +2803,31 @@ class ShutItPexpectSession(object):
 			regexps = [regexps]
 		if not isinstance(regexps, list):
 			shutit.fail('regexps should be list') # pragma: no cover
+		for regexp in regexps:
+			if not shutit_util.check_regexp(regexp):
+				shutit.fail('Illegal regexp found in send_until call: ' + regexp) # pragma: no cover
+		if target_loop:
+			echo = shutit.get_echo_override(echo)
+			ok = self._send_until_target_loop(send,
+			                                  regexps,
+			                                  not_there=not_there,
+			                                  cadence=cadence,
+			                                  retries=retries,
+			                                  echo=echo,
+			                                  debug_command=debug_command,
+			                                  timeout=timeout,
+			                                  backoff=backoff,
+			                                  loglevel=loglevel)
+			shutit.handle_note_after(note=note)
+			if ok:
+				return True
+			if pause_point_on_fail:
+				shutit.pause_point('send_until failed sending: ' + send + '\r\nand expecting: ' + str(regexps))
+			else:
+				return False
+			return None
+		if timeout is not None:
+			deadline = time.time() + timeout
 		while retries > 0:
 			retries -= 1
 			echo = shutit.get_echo_override(echo)
@@ -2037,16 +2841,12 @@ class ShutItPexpectSession(object):
 			shutit.log('Failed to match regexps -> ' + str(regexps) + ' <- retries left:' + str(retries),level=loglevel)
 			if not not_there:
 				for regexp in regexps:
-					if not shutit_util.check_regexp(regexp):
-						shutit.fail('Illegal regexp found in send_until call: ' + regexp) # pragma: no cover
 					if shutit_util.match_string(shutit, output, regexp):
 						return True
 			else:
 				# Only return if _not_ seen in the output
 				missing = False
 				for regexp in regexps:
-					if not shutit_util.check_regexp(regexp):
-						shutit.fail('Illegal regexp found in send_until call: ' + regexp) # pragma: no cover
 					if not shutit_util.match_string(shutit, output, regexp):
 						missing = True
 						break
@@ -2060,7 +2860,15 @@ class ShutItPexpectSession(object):
 			              nonewline=nonewline,
 				          loglevel=loglevel,
 			              ignore_background=True,force=True))
-			time.sleep(cadence)
+			sleep = cadence
+			if timeout is not None:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					shutit.log('send_until timed out after ' + str(timeout) + 's',level=loglevel)
+					break
+				sleep = min(cadence, remaining)
+			time.sleep(sleep)
+			cadence *= backoff
 		shutit.handle_note_after(note=note)
 		if pause_point_on_fail:
 			shutit.pause_point('send_until failed sending: ' + send + '\r\nand expecting: ' + str(regexps))
@@ -2068,6 +2876,78 @@ class ShutItPexpectSession(object):
 			return False
 
 
+	def _send_until_target_loop(self,
+	                            send,
+	                            regexps,
+	                            not_there=False,
+	                            cadence=2,
+	                            retries=100,
+	                            echo=None,
+	                            debug_command=None,
+	                            timeout=None,
+	                            backoff=1,
+	                            loglevel=logging.INFO):
+		"""Internal function. Runs the send_until loop on the target, so that
+		only one command is sent and one prompt waited for, whatever the number
+		of attempts. Do not use.
+
+		@return: True if the condition was met, else False.
+		"""
+		shutit = self.shutit
+		# As with match_string, each regexp has to match from the start of a line.
+		greps = ['printf \'%s\\n\' "$_shutit_out" | command grep -E -q -e ' + shutit_util.shell_quote('^(' + regexp + ')') for regexp in regexps]
+		if not_there:
+			# True if any of the regexps is not seen.
+			test = ' || '.join(['! ' + grep for grep in greps])
+		else:
+			test = ' || '.join(greps)
+		if backoff == 1:
+			next_sleep = ''
+		else:
+			next_sleep = ' _shutit_sleep=$(command awk -v s=$_shutit_sleep -v b=' + str(backoff) + ' \'BEGIN{print s*b}\');'
+		# Without a timeout the loop is still bounded by the default send timeout,
+		# so that it finishes before the wait for the prompt gives up on it.
+		if timeout is None:
+			timeout = 3600
+		deadline_init = ' _shutit_end=$(( $(command date +%s) + ' + str(int(timeout)) + ' ));'
+		# No sleep may run past the deadline.
+		if backoff == 1 and isinstance(cadence, int):
+			clamp_sleep = ' [ $_shutit_sleep -gt $_shutit_left ] && _shutit_sleep=$_shutit_left;'
+		else:
+			clamp_sleep = ' _shutit_sleep=$(command awk -v s=$_shutit_sleep -v l=$_shutit_left \'BEGIN{print (s<l)?s:l}\');'
+		deadline_test = (' _shutit_left=$(( _shutit_end - $(command date +%s) ));' +
+		                 ' [ $_shutit_left -le 0 ] && break;' + clamp_sleep)
+		debug = ''
+		if debug_command is not None:
+			debug = ' ' + debug_command + ';'
+		# The quotes in the middle of the markers are there to prevent the output matching the command.
+		loop = (' _shutit_n=0; _shutit_ok=0; _shutit_sleep=' + str(cadence) + ';' + deadline_init +
+		        ' while true; do _shutit_n=$(( _shutit_n + 1 ));' +
+		        ' _shutit_out=$( { ' + send + ' ; } 2>&1 );' +
+		        ' if ' + test + '; then _shutit_ok=1; break; fi;' +
+		        ' [ $_shutit_n -ge ' + str(retries) + ' ] && break;' +
+		        debug + deadline_test +
+		        ' command sleep $_shutit_sleep;' + next_sleep +
+		        ' done; echo SHUTIT_UNTIL""_OUTPUT; printf \'%s\\n\' "$_shutit_out"; echo SHUTIT_UNTIL""_RESULT:$_shutit_ok:$_shutit_n;' +
+		        ' unset _shutit_n _shutit_ok _shutit_sleep _shutit_end _shutit_left _shutit_out')
+		output = self.send_and_get_output(loop,
+		                                  timeout=timeout + 60,
+		                                  retry=1,
+		                                  echo=echo,
+		                                  preserve_newline=True,
+		                                  loglevel=loglevel,
+		                                  fail_on_empty_before=False)
+		res = re.search(r'SHUTIT_UNTIL_OUTPUT\r?\n(.*)SHUTIT_UNTIL_RESULT:([01]):([0-9]+)', output, re.DOTALL)
+		if res is None:
+			shutit.fail('send_until loop did not complete as expected, output:\n' + output) # pragma: no cover
+		shutit.log('send_until output after ' + res.group(3) + ' attempt(s):\n' + res.group(1),level=logging.DEBUG)
+		if res.group(2) == '1':
+			shutit.log('send_until condition met after ' + res.group(3) + ' attempt(s)',level=loglevel)
+			return True
+		shutit.log('Failed to match regexps -> ' + str(regexps) + ' <- after ' + res.group(3) + ' attempt(s)',level=loglevel)
+		return False
+
+
 	def change_text(self,
 	                text,
 	                fname,
@@ -2397,7 +3277,6 @@ class ShutItPexpectSession(object):
 			# _check_blocked will add to the list of background tasks and handle dupes, so leave there.
 			return -1
 		shutit = self.shutit
-		cfg = shutit.cfg
 		# Set up what we expect.
 		sendspec.expect = sendspec.expect or self.default_expect
 		if sendspec.send.strip() == '':
@@ -2482,16 +3361,11 @@ class ShutItPexpectSession(object):
 			sendspec.record_command = False
 		if sendspec.record_command is None or sendspec.record_command:
 			ok_to_record = True
-			for i in cfg.keys():
-				if isinstance(cfg[i], dict):
-					for j in cfg[i].keys():
-						if (j == 'password' or j == 'passphrase') and cfg[i][j] == sendspec.send:
-							shutit.build['shutit_command_history'].append ('#redacted command, password')
-							ok_to_record = False
-							break
-				if not ok_to_record or sendspec.send in shutit_global.shutit_global_object.secret_words_set:
-					sendspec.secret = True
-					break
+			# Config passwords are added to the secret words when the config is read.
+			if sendspec.send in shutit_global.shutit_global_object.secret_words_set:
+				shutit.build['shutit_command_history'].append('#redacted command, password')
+				sendspec.secret = True
+				ok_to_record = False
 			if ok_to_record:
 				shutit.build['shutit_command_history'].append(sendspec.send)
 		if sendspec.send != None:
@@ -2682,26 +3556,30 @@ $'"""
 			if isinstance(self.pexpect_child.after, type) or isinstance(self.pexpect_child.before, type):
 				shutit.log('End of pexpect session detected, bailing.',level=logging.CRITICAL)
 				shutit_util.handle_exit(exit_code=1)
-			logged_output = ''.join((self.pexpect_child.before + str(self.pexpect_child.after)).split('\n'))
-			logged_output = logged_output.replace(sendspec.send,'',1)
-			logged_output = logged_output.replace('\r','')
-			output_length = 160
-			if len(logged_output) > output_length:
-				logged_output = logged_output[:output_length] + ' [...]'
 			if not sendspec.secret:
+				# The output is only squashed (and dumped below) if it is going to be logged.
+				def squashed_output():
+					logged_output = ''.join((self.pexpect_child.before + str(self.pexpect_child.after)).split('\n'))
+					logged_output = logged_output.replace(sendspec.send,'',1)
+					logged_output = logged_output.replace('\r','')
+					output_length = 160
+					if len(logged_output) > output_length:
+						logged_output = logged_output[:output_length] + ' [...]'
+					return 'Output (squashed): ' + logged_output
 				if sendspec.echo:
-					shutit.log('Output (squashed): ' + logged_output,level=logging.DEBUG)
+					shutit.log(squashed_output,level=logging.DEBUG)
 				else:
-					shutit.log('Output (squashed): ' + logged_output,level=sendspec.loglevel)
-				try:
-					shutit.log('shutit_pexpect_child.buffer(hex)>>>\n'  + binascii.hexlify(self.pexpect_child.buffer) + '\n<<<',level=logging.DEBUG)
-					shutit.log('shutit_pexpect_child.before (hex)>>>\n' + binascii.hexlify(self.pexpect_child.before) + '\n<<<',level=logging.DEBUG)
-					shutit.log('shutit_pexpect_child.after (hex)>>>\n'  + binascii.hexlify(self.pexpect_child.after) + '\n<<<',level=logging.DEBUG)
-				except Exception as e:
-					shutit.log('Exception at 2665: ' + str(e),level=logging.WARNING)
-				shutit.log('shutit_pexpect_child.buffer>>>\n' + str(self.pexpect_child.buffer) + '\n<<<',level=logging.DEBUG)
-				shutit.log('shutit_pexpect_child.before>>>\n' + str(self.pexpect_child.before) + '\n<<<',level=logging.DEBUG)
-				shutit.log('shutit_pexpect_child.after>>>\n' + str(self.pexpect_child.after) + '\n<<<',level=logging.DEBUG)
+					shutit.log(squashed_output,level=sendspec.loglevel)
+				if logging.getLogger().isEnabledFor(logging.DEBUG):
+					try:
+						shutit.log('shutit_pexpect_child.buffer(hex)>>>\n'  + binascii.hexlify(self.pexpect_child.buffer) + '\n<<<',level=logging.DEBUG)
+						shutit.log('shutit_pexpect_child.before (hex)>>>\n' + binascii.hexlify(self.pexpect_child.before) + '\n<<<',level=logging.DEBUG)
+						shutit.log('shutit_pexpect_child.after (hex)>>>\n'  + binascii.hexlify(self.pexpect_child.after) + '\n<<<',level=logging.DEBUG)
+					except Exception as e:
+						shutit.log('Exception at 2665: ' + str(e),level=logging.WARNING)
+					shutit.log('shutit_pexpect_child.buffer>>>\n' + str(self.pexpect_child.buffer) + '\n<<<',level=logging.DEBUG)
+					shutit.log('shutit_pexpect_child.before>>>\n' + str(self.pexpect_child.before) + '\n<<<',level=logging.DEBUG)
+					shutit.log('shutit_pexpect_child.after>>>\n' + str(self.pexpect_child.after) + '\n<<<',level=logging.DEBUG)
 			else:
 				shutit.log('[Send was marked secret; getting output debug will require code change]',level=logging.DEBUG)
 			if sendspec.fail_on_empty_before:
@@ -2710,7 +3588,7 @@ $'"""
 			elif not sendspec.fail_on_empty_before:
 				# Don't check exit if fail_on_empty_before is False
 				if not sendspec.secret:
-					shutit.log('' + self.pexpect_child.before + '<<<', level=logging.DEBUG)
+					shutit.log(lambda: self.pexpect_child.before + '<<<', level=logging.DEBUG)
 				sendspec.check_exit = False
 				for prompt in shutit.expect_prompts:
 					if prompt == sendspec.expect:
@@ -2808,10 +3686,39 @@ $'"""
 			split_contents = ''.join((contents[:10000].split()))
 		strings_from_file = re.findall("[^\x00-\x1F\x7F-\xFF]", split_contents)
 		shutit.log('Sending file contents beginning: "' + ''.join(strings_from_file)[:30] + ' [...]" to file: ' + path, level=loglevel)
+		# Only the paths that stream the file need to know whether ownership was asked for.
+		owner = (user, group)
 		if user is None:
 			user = self.whoami()
 		if group is None:
 			group = self.whoarewe()
+		# The bytes sent are worked out once, and shared with the streaming send paths.
+		payload = self._get_file_payload(contents, encoding)
+		# The docker paths set ownership whether or not it was asked for, so a copy from the cache must too.
+		if shutit.build['delivery'] == 'docker':
+			cache_owner = (user, group)
+		else:
+			cache_owner = owner
+		self._send_file_cached(path,
+		                       len(payload),
+		                       lambda: hashlib.sha256(payload).hexdigest(),
+		                       lambda: self._send_file_contents(path, contents, echo, truncate, user, group, owner, loglevel, encoding, payload),
+		                       truncate=truncate,
+		                       user=cache_owner[0],
+		                       group=cache_owner[1],
+		                       loglevel=loglevel)
+		shutit.handle_note_after(note=note)
+		return True
+
+
+	def _send_file_contents(self, path, contents, echo, truncate, user, group, owner, loglevel, encoding, payload):
+		"""Internal function. Sends the passed-in contents to path by whichever
+		means suits the delivery method. See send_file. Do not use.
+
+		@param owner:   The user and group passed to send_file, before defaulting.
+		@param payload: The contents as bytes (see _get_file_payload).
+		"""
+		shutit = self.shutit
 		if self.current_environment.environment_id == 'ORIGIN_ENV' and False:
 			# If we're on the root env (ie the same one that python is running on, then use python.
 			if isinstance(contents, str):
@@ -2839,6 +3746,10 @@ $'"""
 			else:
 				shutit.fail('type: ' + str(type(contents)) + ' not handled in 1') # pragma: no cover
 			f.close()
+		elif shutit.build['delivery'] in ('bash','dockerfile') and shutit.build['chunked_send_file'] and self._get_chunked_send_commands() is not None:
+			self.send_file_chunked(path, io.BytesIO(payload), truncate=truncate, user=owner[0], group=owner[1], loglevel=loglevel)
+		elif shutit.build['delivery'] == 'docker' and self.can_send_file_docker_exec():
+			self.send_file_docker_exec(path, io.BytesIO(payload), user=user, group=group, loglevel=loglevel)
 		elif shutit.build['delivery'] in ('bash','dockerfile'):
 			if truncate and self.file_exists(path):
 				self.send(ShutItSendSpec(self,send=' command rm -f ' + path,
@@ -2923,10 +3834,497 @@ $'"""
 			                         loglevel=loglevel,
 			                         ignore_background=True,force=True))
 			os.remove(tmpfile)
+
+
+	def _send_file_cached(self,
+	                      path,
+	                      size,
+	                      get_checksum,
+	                      send_function,
+	                      truncate=False,
+	                      user=None,
+	                      group=None,
+	                      loglevel=logging.DEBUG):
+		"""Internal function. Sends a file to path by calling send_function,
+		unless a file with the same sha256 has already been sent to this
+		environment, in which case it is copied from the transfer cache on the
+		target. Files that are sent are then added to the cache. Do not use.
+
+		@param size:          Size of the file in bytes.
+		@param get_checksum:  Called with no arguments to get the file's sha256.
+		@param send_function: Called with no arguments to send the file.
+		@param truncate:      See send_file()
+		@param user:          If set, the user to give a file copied from the cache.
+		@param group:         If set, the group to give a file copied from the cache.
+		"""
+		shutit = self.shutit
+		checksum = None
+		# Relative paths are not cached, as the docker path treats them as relative to $HOME.
+		# Below 4096 bytes sending the file costs no more than looking it up.
+		# Image-building deliveries would commit the cache into the image, so do not use it.
+		if (shutit.build['transfer_cache'] and shutit.build['delivery'] not in ('docker','dockerfile') and
+		    path.startswith('/') and size >= 4096 and self._get_sha256_command() is not None):
+			checksum = get_checksum()
+			if checksum in self.current_environment.transfer_cache_files:
+				if self._transfer_cache_get(checksum, path, truncate=truncate, user=user, group=group, loglevel=loglevel):
+					return
+			else:
+				self.current_environment.transfer_cache_misses += 1
+		send_function()
+		if checksum is not None and self.current_environment.transfer_cache_bytes + size <= shutit.build['transfer_cache_max_mb'] * 1048576:
+			self._transfer_cache_put(checksum, path, size)
+
+
+	def _get_transfer_cache_dir(self):
+		"""Internal function. Returns the transfer cache directory on the target. Do not use.
+		"""
+		return self.shutit.build['shutit_state_dir'] + '/transfer_cache'
+
+
+	def _transfer_cache_get(self, checksum, path, truncate=False, user=None, group=None, loglevel=logging.DEBUG):
+		"""Internal function. Copies the file with the passed-in sha256 to path
+		from the transfer cache on the target, in one round trip. The cached
+		file's checksum is checked before it is used. Do not use.
+
+		@return: True if the file was found in the cache.
+		"""
+		shutit = self.shutit
+		cache_dir = shutit_util.shell_quote(self._get_transfer_cache_dir())
+		cache_file = shutit_util.shell_quote(self._get_transfer_cache_dir() + '/' + checksum)
+		quoted_path = shutit_util.shell_quote(path)
+		# Only a directory that is private to this user is trusted.
+		copy = ('[ -d ' + cache_dir + ' ] && [ ! -L ' + cache_dir + ' ] && [ -O ' + cache_dir + ' ]' +
+		        ' && test "$(' + self._get_sha256_command() + ' < ' + cache_file + ' | command cut -c1-64)" = "' + checksum + '"')
+		if truncate:
+			copy += ' && command rm -f ' + quoted_path
+		# Written with cat rather than cp, so the file gets the same mode it would have had if sent.
+		copy += ' && command cat ' + cache_file + ' > ' + quoted_path
+		if user is not None:
+			copy += ' && command chown ' + shutit_util.shell_quote(user) + ' ' + quoted_path
+		if group is not None:
+			copy += ' && command chgrp ' + shutit_util.shell_quote(group) + ' ' + quoted_path
+		# The quotes in the middle of the result strings are there to prevent the output matching the command.
+		assert not self.sendline(ShutItSendSpec(self,send=' { ' + copy + '; } 2>/dev/null && echo SHUTIT_TC""_HIT || echo SHUTIT_TC""_MISS',ignore_background=True,force=True))
+		res = self.expect(['SHUTIT_TC_HIT','SHUTIT_TC_MISS'])
+		self.expect(self.default_expect)
+		if res == 0:
+			self.current_environment.transfer_cache_hits += 1
+			shutit.log('File for ' + path + ' copied from transfer cache', level=loglevel)
+			return True
+		self.current_environment.transfer_cache_misses += 1
+		return False
+
+
+	def _transfer_cache_put(self, checksum, path, size):
+		"""Internal function. Copies the file just sent to path into the
+		transfer cache on the target, under its sha256. Do not use.
+		"""
+		cache_dir = shutit_util.shell_quote(self._get_transfer_cache_dir())
+		cache_file = self._get_transfer_cache_dir() + '/' + checksum
+		# The cache is kept in a directory only this user can read or write, which
+		# is not used if it turns out to be a link or owned by someone else.
+		# Entries are copied under a temporary name first so a partial copy is never found.
+		tmp_file = shutit_util.shell_quote(cache_file + '.tmp')
+		# The quotes in the middle of the result strings are there to prevent the output matching the command.
+		put = (' { command mkdir -p ' + cache_dir + ' && [ ! -L ' + cache_dir + ' ] && [ -O ' + cache_dir + ' ] && command chmod 700 ' + cache_dir +
+		       ' && command rm -f ' + tmp_file + ' && command cp -f ' + shutit_util.shell_quote(path) + ' ' + tmp_file +
+		       ' && command mv -f ' + tmp_file + ' ' + shutit_util.shell_quote(cache_file) + '; } 2>/dev/null && echo SHUTIT_TC""_STORED || echo SHUTIT_TC""_FAILED')
+		assert not self.sendline(ShutItSendSpec(self,send=put,ignore_background=True,force=True))
+		res = self.expect(['SHUTIT_TC_STORED','SHUTIT_TC_FAILED'])
+		self.expect(self.default_expect)
+		if res == 0:
+			self.current_environment.transfer_cache_files.add(checksum)
+			self.current_environment.transfer_cache_bytes += size
+
+
+	def clear_transfer_cache(self, loglevel=logging.DEBUG):
+		"""Removes the transfer cache from the target, if files were stored in it
+		from the current environment.
+		"""
+		if not self.current_environment.transfer_cache_files:
+			return
+		self.send(ShutItSendSpec(self,send=' command rm -rf ' + shutit_util.shell_quote(self._get_transfer_cache_dir()),
+		                         echo=False,
+		                         check_exit=False,
+		                         loglevel=loglevel,
+		                         ignore_background=True,force=True))
+		self.current_environment.transfer_cache_files = set()
+		self.current_environment.transfer_cache_bytes = 0
+
+
+	def _get_file_payload(self, contents, encoding):
+		"""Internal function. Returns the passed-in file contents as bytes. Do not use.
+		"""
+		if isinstance(contents, bytes):
+			return contents
+		elif encoding is not None:
+			return contents.encode(encoding)
+		return contents.encode('utf-8')
+
+
+	def can_send_file_docker_exec(self):
+		"""Returns True if files can be piped straight into the target
+		container with send_file_docker_exec.
+
+		@rtype: boolean
+		"""
+		shutit = self.shutit
+		# If docker needs sudo, the password can only be given on the host pty.
+		return (shutit.build['docker_exec_send_file'] and
+		        shutit.target.get('container_id') is not None and
+		        shutit.host['docker_executable'].split(' ')[0] != 'sudo')
+
+
+	def send_file_docker_exec(self,
+	                          path,
+	                          source,
+	                          user=None,
+	                          group=None,
+	                          block_size=1048576,
+	                          note=None,
+	                          loglevel=logging.INFO):
+		"""Pipes a file from the host straight into 'docker exec -i' on the
+		target container, without a temporary file on the host or going
+		through the host's pty. The file's ownership is set in the same step.
+
+		@param path:        Target location of file on target (relative paths are from $HOME).
+		@param source:      Path of the file on the host, or a file object open for reading.
+		@param user:        Set ownership to this user (defaults to whoami)
+		@param group:       Set group to this user (defaults to first group in groups)
+		@param block_size:  Number of bytes to read and write at a time.
+		@param note:        See send()
+
+		@type path:         string
+		@type block_size:   integer
+
+		@return: True if the file was sent.
+		@rtype:  boolean
+		"""
+		shutit = self.shutit
+		shutit.handle_note(note, 'Sending contents to path: ' + path)
+		if user is None:
+			user = self.whoami()
+		if group is None:
+			group = self.whoarewe()
+		if isinstance(source, str):
+			source_name = source
+			source = open(source, 'rb')
+			close_source = True
+		else:
+			source_name = str(getattr(source, 'name', 'file object'))
+			close_source = False
+		# The path, user and group are passed as arguments, so need no quoting.
+		script = 'case "$1" in /*) ;; *) cd "$HOME" ;; esac && cat > "$1" && chown "$2:$3" "$1"'
+		command = shutit.host['docker_executable'].split(' ') + ['exec', '-i', shutit.target['container_id'], 'sh', '-c', script, 'sh', path, user, group]
+		shutit.log('Streaming: ' + source_name + ' to file: ' + path + ' with: ' + ' '.join(command[:-6]), level=loglevel)
+		start_time = time.time()
+		bytes_sent = 0
+		proc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		try:
+			while True:
+				data = source.read(block_size)
+				if not data:
+					break
+				if not isinstance(data, bytes):
+					data = data.encode('utf-8')
+				proc.stdin.write(data)
+				bytes_sent += len(data)
+		except (IOError, OSError):
+			# The process has gone away - its output will say why.
+			pass
+		finally:
+			if close_source:
+				source.close()
+		output = proc.communicate()[0]
+		if proc.returncode != 0:
+			shutit.fail('send_file_docker_exec: failed to send ' + source_name + ' to ' + path + ':\n' + output.decode('utf-8', 'replace')) # pragma: no cover
+		elapsed = max(time.time() - start_time, 0.001)
+		shutit.log('Sent ' + str(bytes_sent) + ' bytes to ' + path + ' via docker exec in ' + '%.2f' % elapsed + 's (' + '%.2f' % (bytes_sent / elapsed / 1048576) + ' MB/s)', level=loglevel)
 		shutit.handle_note_after(note=note)
 		return True
 
 
+	def send_file_chunked(self,
+	                      path,
+	                      source,
+	                      frame_size=1048576,
+	                      truncate=False,
+	                      user=None,
+	                      group=None,
+	                      note=None,
+	                      loglevel=logging.INFO):
+		"""Streams a file to the passed-in path on the target in bounded-size
+		frames, so large files can be sent without being held in memory.
+
+		The data is gzipped on the fly (if gunzip is available on the target)
+		and base64-encoded, and each frame is appended to a temporary file
+		next to the destination. Once all frames are sent the file is unpacked
+		and its sha256 checked before the destination is touched, so a failed
+		send never leaves it half-written.
+
+		@param path:        Target location of file on target.
+		@param source:      Path of the file on the host, or a file object open for reading.
+		@param frame_size:  Maximum number of (compressed) bytes to send in each frame.
+		@param truncate:    If True, replace any existing file at path. If False
+		                    (default), an existing file is overwritten in place,
+		                    keeping its ownership and mode.
+		@param user:        Set ownership to this user (default: leave as is)
+		@param group:       Set group to this group (default: leave as is)
+		@param note:        See send()
+
+		@type path:         string
+		@type frame_size:   integer
+
+		@return: True if the file was sent and verified.
+		@rtype:  boolean
+		"""
+		shutit = self.shutit
+		shutit.handle_note(note, 'Sending contents to path: ' + path)
+		commands = self._get_chunked_send_commands()
+		if commands is None:
+			shutit.fail('send_file_chunked: base64 and sha256sum (or shasum) are needed on the target to send ' + path) # pragma: no cover
+		sha_command, decompress = commands
+		if isinstance(source, str):
+			source_name = source
+			source = open(source, 'rb')
+			close_source = True
+		else:
+			source_name = str(getattr(source, 'name', 'file object'))
+			close_source = False
+		random_id = shutit_util.random_id()
+		tmp_packed = path + '.shutit_' + random_id + '.part'
+		tmp_file = path + '.shutit_' + random_id
+		shutit.log('Streaming: ' + source_name + ' to file: ' + path, level=loglevel)
+		checksum = hashlib.sha256()
+		if decompress:
+			compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		else:
+			compressor = None
+		start_time = time.time()
+		bytes_read = 0
+		bytes_sent = 0
+		frames = 0
+		frame = []
+		frame_len = 0
+		try:
+			while True:
+				data = source.read(frame_size)
+				if not data:
+					break
+				if not isinstance(data, bytes):
+					data = data.encode('utf-8')
+				bytes_read += len(data)
+				checksum.update(data)
+				if compressor is not None:
+					data = compressor.compress(data)
+				if data:
+					frame.append(data)
+					frame_len += len(data)
+				if frame_len >= frame_size:
+					self._send_file_frame(tmp_packed, b''.join(frame), frames)
+					frames += 1
+					bytes_sent += frame_len
+					frame = []
+					frame_len = 0
+		finally:
+			if close_source:
+				source.close()
+		if compressor is not None:
+			frame.append(compressor.flush())
+			frame_len += len(frame[-1])
+		if frame_len or frames == 0:
+			self._send_file_frame(tmp_packed, b''.join(frame), frames)
+			frames += 1
+			bytes_sent += frame_len
+		quoted_path = shutit_util.shell_quote(path)
+		quoted_packed = shutit_util.shell_quote(tmp_packed)
+		quoted_file = shutit_util.shell_quote(tmp_file)
+		if truncate:
+			place = 'command mv -f ' + quoted_file + ' ' + quoted_path
+		else:
+			place = ('{ if [ -e ' + quoted_path + ' ]; then command cat ' + quoted_file + ' > ' + quoted_path + ' && command rm -f ' + quoted_file + ';' +
+			         ' else command mv -f ' + quoted_file + ' ' + quoted_path + '; fi; }')
+		if user is not None:
+			place += ' && command chown ' + shutit_util.shell_quote(user) + ' ' + quoted_path
+		if group is not None:
+			place += ' && command chgrp ' + shutit_util.shell_quote(group) + ' ' + quoted_path
+		# The quotes in the middle of the result strings are there to prevent the output matching the command.
+		finish = (' ' + (decompress or 'command cat') + ' < ' + quoted_packed + ' > ' + quoted_file +
+		          ' && test "$(' + sha_command + ' < ' + quoted_file + ' | command cut -c1-64)" = "' + checksum.hexdigest() + '"' +
+		          ' && ' + place +
+		          ' && echo SHUTIT_SF_""OK || { command rm -f ' + quoted_file + '; echo SHUTIT_SF_""BAD; }; command rm -f ' + quoted_packed)
+		assert not self.sendline(ShutItSendSpec(self,send=finish,ignore_background=True,force=True))
+		res = self.expect(['SHUTIT_SF_OK','SHUTIT_SF_BAD'])
+		self.expect(self.default_expect)
+		if res != 0:
+			shutit.fail('send_file_chunked: ' + path + ' could not be written on the target, or its checksum did not match that of ' + source_name) # pragma: no cover
+		elapsed = max(time.time() - start_time, 0.001)
+		shutit.log('Sent ' + str(bytes_read) + ' bytes (' + str(bytes_sent) + ' packed) to ' + path + ' in ' + str(frames) + ' frames, ' + '%.2f' % elapsed + 's (' + '%.2f' % (bytes_read / elapsed / 1048576) + ' MB/s)', level=loglevel)
+		shutit.handle_note_after(note=note)
+		return True
+
+
+	def _send_file_frame(self, tmp_packed, data, frame_number):
+		"""Internal function. Appends one frame of data to the passed-in file
+		on the target. Do not use.
+		"""
+		if frame_number == 0:
+			redirect = ' > '
+		else:
+			redirect = ' >> '
+		self._send_base64_data(data, 'command base64 --decode' + redirect + shutit_util.shell_quote(tmp_packed))
+		self.expect(self.default_expect, timeout=3600)
+
+
+	def _send_base64_data(self, data, decode_command, follow_on=''):
+		"""Internal function. Sends the passed-in bytes base64-encoded to the
+		stdin of decode_command, followed on the same command line by
+		follow_on. The caller must expect what follows. Do not use.
+
+		The data is typed straight into the command running in the foreground
+		with terminal echo off, and ended with ^D. This avoids the shell
+		echoing it back (as it would with a heredoc), which is slow and can
+		block both sides once the terminal's buffers fill. If the command
+		fails, the rest of the data is read by cat so it is not run by the shell.
+		"""
+		encoded = base64.b64encode(data)
+		if PY3:
+			encoded = encoded.decode('ascii')
+		lines = [encoded[i:i+76] for i in range(0, len(encoded), 76)]
+		# The quotes in the middle of the string are there to prevent the output matching the command.
+		assert not self.sendline(ShutItSendSpec(self,send=' command stty -echo; echo SHUTIT_B64_""READY; { ' + decode_command + ' || command cat > /dev/null; }; command stty echo' + follow_on,ignore_background=True,force=True))
+		self.expect('SHUTIT_B64_READY')
+		self.pexpect_child.send(''.join([line + '\n' for line in lines]) + '\x04')
+
+
+	def get_file_chunked(self,
+	                     target_path,
+	                     host_path,
+	                     frame_size=1048576,
+	                     compress=True,
+	                     note=None,
+	                     loglevel=logging.INFO):
+		"""Streams a file from the target back to a file on the host over this
+		session, one frame at a time, so it works whatever the delivery method.
+
+		Each frame is read on the target with dd, gzipped (if compress is set
+		and gzip is available there) and base64-encoded, and appended to
+		host_path + '.part' as it arrives. If that file is already there from
+		an interrupted download, the download carries on from where it got to.
+		The sha256 of the whole file is checked before the file is renamed to
+		host_path.
+
+		@param target_path: Path to file on the target.
+		@param host_path:   Path to write the file to on the host.
+		@param frame_size:  Number of bytes of the file to send in each frame.
+		@param compress:    Whether to gzip each frame on the target.
+		@param note:        See send()
+
+		@type target_path:  string
+		@type host_path:    string
+		@type frame_size:   integer
+		@type compress:     boolean
+
+		@return: True if the file was fetched and verified.
+		@rtype:  boolean
+		"""
+		shutit = self.shutit
+		shutit.handle_note(note, 'Getting file: ' + target_path + ' to host path: ' + host_path)
+		if self.command_available('sha256sum'):
+			sha_command = 'command sha256sum'
+		elif self.command_available('shasum'):
+			sha_command = 'command shasum -a 256'
+		else:
+			shutit.fail('get_file_chunked: sha256sum (or shasum) is needed on the target to get ' + target_path) # pragma: no cover
+		compress = compress and self.command_available('gzip')
+		quoted_path = shutit_util.shell_quote(target_path)
+		# The quotes in the middle of the marker are there to prevent the output matching the command.
+		self.sendline(ShutItSendSpec(self,send=' echo SHUTIT_GF""_INFO:$(command wc -c < ' + quoted_path + '):$(' + sha_command + ' < ' + quoted_path + ' | command cut -c1-64)',ignore_background=True,force=True))
+		self.expect(r'SHUTIT_GF_INFO:([0-9]*):([0-9a-f]*)\r?\n', timeout=3600)
+		size = self.pexpect_child.match.group(1)
+		checksum = self.pexpect_child.match.group(2)
+		self.expect(self.default_expect)
+		if not size or len(checksum) != 64:
+			shutit.fail('get_file_chunked: could not read ' + target_path + ' on target') # pragma: no cover
+		size = int(size)
+		part_path = host_path + '.part'
+		# Carry on from the last whole frame of any earlier attempt.
+		offset = 0
+		if os.path.isfile(part_path) and os.path.getsize(part_path) <= size:
+			offset = (os.path.getsize(part_path) // frame_size) * frame_size
+		host_checksum = hashlib.sha256()
+		part_file = open(part_path, 'ab' if offset else 'wb')
+		part_file.seek(offset)
+		part_file.truncate()
+		if offset:
+			shutit.log('Resuming download of ' + target_path + ' from byte ' + str(offset), level=loglevel)
+			with open(part_path, 'rb') as f:
+				for block in iter(lambda: f.read(frame_size), b''):
+					host_checksum.update(block)
+		start_time = time.time()
+		bytes_received = 0
+		try:
+			for frame_offset in range(offset, size, frame_size):
+				send = ' echo SHUTIT_GF""_BEGIN; command dd if=' + quoted_path + ' bs=' + str(frame_size) + ' skip=' + str(frame_offset // frame_size) + ' count=1 2>/dev/null'
+				if compress:
+					send += ' | command gzip -c'
+				send += ' | command base64; echo SHUTIT_GF""_END'
+				self.sendline(ShutItSendSpec(self,send=send,ignore_background=True,force=True))
+				self.expect(r'SHUTIT_GF_BEGIN\r?\n')
+				# Only the end of the output need be searched for the marker.
+				self.expect('SHUTIT_GF_END', searchwindowsize=200, timeout=3600)
+				encoded = self.pexpect_child.before
+				self.expect(self.default_expect)
+				if not isinstance(encoded, bytes):
+					encoded = encoded.encode('ascii')
+				bytes_received += len(encoded)
+				data = base64.b64decode(b''.join(encoded.split()))
+				if compress:
+					data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+				if len(data) != min(frame_size, size - frame_offset):
+					shutit.fail('get_file_chunked: got ' + str(len(data)) + ' bytes at offset ' + str(frame_offset) + ' of ' + target_path + ', expected ' + str(min(frame_size, size - frame_offset))) # pragma: no cover
+				host_checksum.update(data)
+				part_file.write(data)
+				part_file.flush()
+		finally:
+			part_file.close()
+		if host_checksum.hexdigest() != checksum:
+			os.remove(part_path)
+			shutit.fail('get_file_chunked: checksum of ' + host_path + ' did not match that of ' + target_path + ' on target') # pragma: no cover
+		os.rename(part_path, host_path)
+		elapsed = max(time.time() - start_time, 0.001)
+		shutit.log('Got ' + str(size - offset) + ' bytes (' + str(bytes_received) + ' encoded) from ' + target_path + ' to ' + host_path + ' in ' + '%.2f' % elapsed + 's (' + '%.2f' % ((size - offset) / elapsed / 1048576) + ' MB/s)', level=loglevel)
+		shutit.handle_note_after(note=note)
+		return True
+
+
+	def _get_sha256_command(self):
+		"""Internal function. Returns the command to use to checksum a file
+		(read on stdin) on the target, or None if there is none. Do not use.
+		"""
+		if self.command_available('sha256sum'):
+			return 'command sha256sum'
+		elif self.command_available('shasum'):
+			return 'command shasum -a 256'
+		return None
+
+
+	def _get_chunked_send_commands(self):
+		"""Internal function. Returns the commands to use to checksum and
+		unpack a chunked file on the target, or None if it cannot be done. Do not use.
+		"""
+		if not self.command_available('base64'):
+			return None
+		sha_command = self._get_sha256_command()
+		if sha_command is None:
+			return None
+		if self.command_available('gunzip'):
+			decompress = 'command gunzip -c'
+		else:
+			decompress = None
+		return sha_command, decompress
+
+
 	def run_script(self,
 	               script,
 	               in_shell=True,
@@ -3240,11 +4638,25 @@ $'"""
 		return True
 
 
-	def init_pexpect_session_environment(self, prefix):
+	def init_pexpect_session_environment(self, prefix, environment_ids=False):
+		"""Sets the current environment for the session, creating it if the
+		target has not been seen before.
+
+		@param prefix:          Prefix for a new environment's id.
+		@param environment_ids: If known, the list of files in the target's
+		                        environment_id directory, or None if the
+		                        directory does not exist. By default, the
+		                        target is asked.
+		"""
 		shutit = self.shutit
 		environment_id_dir = shutit.build['shutit_state_dir'] + '/environment_id'
-		if self.file_exists(environment_id_dir,directory=True):
-			files = self.ls(environment_id_dir)
+		if environment_ids is False:
+			if self.file_exists(environment_id_dir,directory=True):
+				environment_ids = self.ls(environment_id_dir)
+			else:
+				environment_ids = None
+		if environment_ids is not None:
+			files = environment_ids
 			if len(files) != 1 or not isinstance(files, list):
 				if len(files) == 2 and (files[0] == 'ORIGIN_ENV' or files[1] == 'ORIGIN_ENV'):
 					for f in files:
@@ -3290,32 +4702,42 @@ $'"""
 
 
 	def in_screen(self, loglevel=logging.DEBUG):
+		found, res = self._get_fact('in_screen')
+		if found:
+			return res
+		res = False
 		if self.send_and_get_output(' command echo $TMUX',
 		                            record_command=False,
 		                            echo=False,
 		                            loglevel=loglevel) != '':
-			return True
+			res = True
 		elif self.send_and_get_output(' command echo $TERM',
 		                              record_command=False,
 		                              echo=False,
 		                              loglevel=loglevel) == 'screen':
-			return True
-		return False
+			res = True
+		self._set_fact('in_screen', res)
+		return res
 
 
 	# Determines whether we have sudo available, and whether we already have sudo rights cached.
+	# As cached sudo rights expire, the result is only cached for a short time.
 	def check_sudo(self):
 		shutit = self.shutit
+		found, res = self._get_fact('check_sudo', ttl=60)
+		if found:
+			return res
+		res = False
 		if self.command_available('sudo'):
 			self.send(ShutItSendSpec(self,send=' sudo -n echo',
 			                         check_exit=False,
 			                         check_sudo=False,
 			                         ignore_background=True,force=True))
 			if self.send_and_get_output(' echo $?') == '0':
-				shutit.log('check_sudo returning True',level=logging.DEBUG)
-				return True
-		shutit.log('check_sudo returning False',level=logging.DEBUG)
-		return False
+				res = True
+		shutit.log('check_sudo returning ' + str(res),level=logging.DEBUG)
+		self._set_fact('check_sudo', res)
+		return res
 
 
 	# Created specifically to help when logging in and the prompt is not ready.
@@ -3347,7 +4769,7 @@ $'"""
 				if not self.check_sudo():
 					pw = self.get_env_pass(whoiam,'Please input your sudo password in case it is needed (for user: ' + whoiam + ')\nJust hit return if you do not want to submit a password.\n')
 		if isinstance(pw,str):
-			shutit_global.shutit_global_object.secret_words_set.add(pw)
+			shutit_global.shutit_global_object.add_secret_word(pw)
 		return pw
 
 
@@ -3356,22 +4778,61 @@ $'"""
 		"""Internal function. Do not use.
 
 		Takes a long command, and puts it in an executable file ready to run. Returns the filename.
+
+		If base64 and md5sum are available on the target, the command is sent
+		base64-encoded (and gzipped first if large) in one go, and its md5sum
+		checked on arrival. Otherwise it is appended to the file a line's
+		worth at a time.
 		"""
 		shutit = self.shutit
 		random_id = shutit_util.random_id()
 		fname = shutit.build['shutit_state_dir_base'] + '/tmp_' + random_id
-		working_str = send
-		# truncate -s must be used as --size is not supported everywhere (eg busybox)
-		assert not self.sendline(ShutItSendSpec(self,send=' truncate -s 0 '+ fname,ignore_background=True, force=True))
-		self.pexpect_child.expect(expect)
-		size = shutit.build['stty_cols'] - 25
-		while len(working_str) > 0:
-			curr_str = working_str[:size]
-			working_str = working_str[size:]
-			assert not self.sendline(ShutItSendSpec(self,send=' ' + shutit_util.get_command(shutit, 'head') + ''' -c -1 >> ''' + fname + """ << 'END_""" + random_id + """'\n""" + curr_str + """\nEND_""" + random_id,ignore_background=True, force=True))
+		if not (self.command_available('base64') and self.command_available('md5sum')):
+			working_str = send
+			# truncate -s must be used as --size is not supported everywhere (eg busybox)
+			assert not self.sendline(ShutItSendSpec(self,send=' truncate -s 0 '+ fname,ignore_background=True, force=True))
+			self.pexpect_child.expect(expect)
+			size = shutit.build['stty_cols'] - 25
+			while len(working_str) > 0:
+				curr_str = working_str[:size]
+				working_str = working_str[size:]
+				assert not self.sendline(ShutItSendSpec(self,send=' ' + shutit_util.get_command(shutit, 'head') + ''' -c -1 >> ''' + fname + """ << 'END_""" + random_id + """'\n""" + curr_str + """\nEND_""" + random_id,ignore_background=True, force=True))
+				self.expect(expect)
+			assert not self.sendline(ShutItSendSpec(self,send=' chmod +x ' + fname,ignore_background=True, force=True))
 			self.expect(expect)
-		assert not self.sendline(ShutItSendSpec(self,send=' chmod +x ' + fname,ignore_background=True, force=True))
-		self.expect(expect)
+			return fname
+		if PY3:
+			payload = send.encode('utf-8')
+		else:
+			payload = send
+		checksum = md5(payload).hexdigest()
+		# If gunzip is not available on the target, the checksum will fail, so try again uncompressed.
+		if len(payload) > 4096:
+			compress_options = [True, False]
+		else:
+			compress_options = [False]
+		for compress in compress_options:
+			if compress:
+				gzipped = io.BytesIO()
+				gzip_file = gzip.GzipFile(fileobj=gzipped, mode='wb')
+				gzip_file.write(payload)
+				gzip_file.close()
+				data = gzipped.getvalue()
+				decompress = ' | command gunzip'
+			else:
+				data = payload
+				decompress = ''
+			shutit.log('Sending command file ' + fname + ': ' + str(len(payload)) + ' bytes, ' + str(len(data)) + ' sent' + (' (gzipped)' if compress else ''),level=logging.DEBUG)
+			# The quotes in the middle of the result strings are there to prevent the output matching the command.
+			self._send_base64_data(data,
+			                       'command base64 --decode' + decompress + ' > ' + fname,
+			                       follow_on='; command chmod +x ' + fname + ' && test "$(' + shutit_util.get_command(shutit, 'md5sum') + ' < ' + fname + ' | command cut -c1-32)" = "' + checksum + '" && echo SHUTIT_CF_""OK || echo SHUTIT_CF_""BAD')
+			res = self.expect(['SHUTIT_CF_OK','SHUTIT_CF_BAD'])
+			self.expect(expect)
+			if res == 0:
+				return fname
+			shutit.log('Checksum of command file ' + fname + ' did not match' + (', trying without compression' if compress else ''),level=logging.DEBUG)
+		shutit.fail('Could not create command file ' + fname + ' on target, checksum did not match') # pragma: no cover
 		return fname
 
 
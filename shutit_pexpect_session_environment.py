@@ -1,3 +1,4 @@
+import time
 import shutit_util
 
 class ShutItPexpectSessionEnvironment(object):
@@ -26,6 +27,50 @@ class ShutItPexpectSessionEnvironment(object):
 		self.build['apt_update_done']     = False
 		self.build['emerge_update_done']  = False
 		self.build['apk_update_done']     = False
+		# Cache of facts about the environment (eg whoami), keyed by tuple.
+		# Each value is a (value, time stored) tuple.
+		self.facts                        = {}
+		self.fact_cache_hits              = 0
+		self.fact_cache_misses            = 0
+		# Counts of files found (or not) in the transfer cache on the target.
+		self.transfer_cache_hits          = 0
+		self.transfer_cache_misses        = 0
+		# The sha256s of the files stored in the transfer cache, and their total size.
+		self.transfer_cache_files         = set()
+		self.transfer_cache_bytes         = 0
+
+	def get_fact(self, key, ttl=None):
+		"""Looks up a cached fact.
+
+		@param key: Tuple identifying the fact, eg ('session_id', 'whoami')
+		@param ttl: If set, facts older than this many seconds are ignored.
+
+		@return: (True, value) if found, else (False, None)
+		@rtype: tuple
+		"""
+		if key in self.facts:
+			value, stored = self.facts[key]
+			if ttl is None or time.time() - stored < ttl:
+				self.fact_cache_hits += 1
+				return True, value
+		self.fact_cache_misses += 1
+		return False, None
+
+	def set_fact(self, key, value):
+		"""Stores a fact in the cache.
+		"""
+		self.facts[key] = (value, time.time())
+
+	def invalidate_facts(self, session_id=None, name=None):
+		"""Removes cached facts, optionally only those for the given session
+		and/or fact name.
+		"""
+		for key in list(self.facts.keys()):
+			if session_id is not None and key[0] != session_id:
+				continue
+			if name is not None and key[1] != name:
+				continue
+			del self.facts[key]
 
 	def __str__(self):
 		string = ''
@@ -40,4 +85,5 @@ class ShutItPexpectSessionEnvironment(object):
 		string += 'distro_version               = ' + str(self.distro_version)
 		string += 'users                        = ' + str(self.users)
 		string += 'self.build                   = ' + str(self.build)
+		string += 'facts                        = ' + str(self.facts)
 		return string
@@ -33,6 +33,8 @@ except ImportError: # pragma: no cover
 import argparse
 import base64
 import binascii
+import collections
+import fcntl
 import getpass
 import glob
 import hashlib
@@ -44,6 +46,7 @@ import os
 import random
 import re
 import readline
+import select
 import stat
 import string
 import sys
@@ -69,6 +72,10 @@ PY3 = (sys.version_info[0] >= 3)
 
 allowed_delivery_methods = ['ssh','dockerfile','bash','docker','vagrant']
 
+# Most recently used compiled regexps (see compile_regexp).
+compiled_regexps     = collections.OrderedDict()
+compiled_regexps_max = 256
+
 
 class LayerConfigParser(ConfigParser.RawConfigParser):
 
@@ -211,6 +218,82 @@ def random_id(size=8, chars=string.ascii_letters + string.digits):
 	return ''.join(random.choice(chars) for _ in range(size))
 
 
+# Commands that do not change anything that is cached about a shell (see
+# is_read_only_command).
+_read_only_commands = frozenset(('', 'echo', 'printf', 'cat', 'ls', 'test', '[', '[[', 'grep', 'egrep', 'fgrep',
+                                 'stat', 'whoami', 'id', 'groups', 'pwd', 'md5sum', 'sha1sum', 'sha256sum', 'shasum',
+                                 'head', 'tail', 'wc', 'cut', 'tr', 'sort', 'uniq', 'awk', 'uname', 'hostname',
+                                 'date', 'printenv', 'true', 'false', 'type', 'which', 'sleep', 'cd', 'base64',
+                                 'lsb_release', 'dpkg-query', 'file', 'du', 'df', 'ps', 'readlink', 'basename', 'dirname'))
+# Shell keywords that may come before a command, which is classified in their place.
+_shell_keywords = frozenset(('command', 'builtin', 'do', 'done', 'if', 'then', 'else', 'elif', 'fi',
+                             'while', 'until', 'esac', '!', 'time'))
+# Options that make find change the filesystem or run other commands.
+_find_actions = frozenset(('-exec', '-execdir', '-ok', '-okdir', '-delete', '-fprint', '-fprint0', '-fprintf', '-fls'))
+
+
+def is_read_only_command(command):
+	"""Returns True if the passed-in command line is known not to change the
+	state of the shell or system, ie every command in it is on a list of
+	read-only commands and it writes to no file other than /dev/null.
+
+	Used to decide when cached facts about a shell (see fact_cache) must be
+	forgotten, so it errs on the side of returning False.
+
+	@param command: The command line.
+	@type command:  string
+	@rtype:         boolean
+	"""
+	command = re.sub(r'[0-9&]?>>?\s*(/dev/null|&[0-9])', '', command)
+	if '>' in command or '<<' in command:
+		return False
+	for part in re.split(r'\|\||&&|[;|&\n(){}`]|\$\(', command):
+		words = part.split()
+		while words and words[0] in _shell_keywords:
+			words = words[1:]
+		# The head of a for loop only sets the loop variable; its body is checked separately.
+		if words and words[0] == 'for':
+			continue
+		# sed is read-only unless editing in place; command -v/-V only looks.
+		if words and words[0] == 'sed' and not [w for w in words if w.startswith('-i')]:
+			continue
+		if words and words[0] in ('-v', '-V'):
+			continue
+		if words and words[0] == 'find' and not _find_actions.intersection(words):
+			continue
+		# rpm only queries with -q.
+		if words and words[0] == 'rpm' and len(words) > 1 and words[1].startswith('-q'):
+			continue
+		if (words[0] if words else '') not in _read_only_commands:
+			return False
+	return True
+
+
+def shell_quote(string):
+	"""Quotes the passed-in string so that the shell treats it as a single word.
+
+	@param string: The string to quote.
+	@type string:  string
+	@rtype:        string
+	"""
+	return "'" + string.replace("'", "'\"'\"'") + "'"
+
+
+def get_file_sha256(filename):
+	"""Returns the sha256 hex digest of the passed-in file on the host,
+	reading it a block at a time.
+
+	@param filename: Path to the file.
+	@type filename:  string
+	@rtype:          string
+	"""
+	checksum = hashlib.sha256()
+	with open(filename, 'rb') as f:
+		for block in iter(lambda: f.read(1048576), b''):
+			checksum.update(block)
+	return checksum.hexdigest()
+
+
 def random_word(size=6):
 	"""Returns a random word in lower case.
 	"""
@@ -321,6 +404,28 @@ def get_base_config(shutit, cfg_parser):
 	shutit.build['have_read_config_file']      = False
 	# Width of terminal to set up on login and assume for other cases.
 	shutit.build['stty_cols']                  = 320
+	# Whether to put the exit code in the prompt, saving a round trip per command.
+	shutit.build['exit_code_in_prompt']        = cp.getboolean('build', 'exit_code_in_prompt')
+	# Whether to use an out-of-band channel for command completion where possible.
+	shutit.build['control_channel']            = cp.getboolean('build', 'control_channel')
+	# Whether to skip the delay before sending when the shell is known to be at its prompt.
+	shutit.build['zero_delay_send']            = cp.getboolean('build', 'zero_delay_send')
+	# Whether to cache facts such as whoami and command_available per shell.
+	shutit.build['fact_cache']                 = cp.getboolean('build', 'fact_cache')
+	# Whether to search only the tail of the output when waiting for a prompt.
+	shutit.build['bounded_prompt_search']      = cp.getboolean('build', 'bounded_prompt_search')
+	# Whether to stream files to bash targets in compressed, checksummed frames.
+	shutit.build['chunked_send_file']          = cp.getboolean('build', 'chunked_send_file')
+	# Whether to pipe files straight into 'docker exec -i' for docker delivery.
+	shutit.build['docker_exec_send_file']      = cp.getboolean('build', 'docker_exec_send_file')
+	# Whether send_host_dir sends only new or changed files by default.
+	shutit.build['delta_send_host_dir']        = cp.getboolean('build', 'delta_send_host_dir')
+	# Whether to keep a copy of files sent on the target, to avoid sending them again.
+	shutit.build['transfer_cache']             = cp.getboolean('build', 'transfer_cache')
+	# Maximum size in MB of the files kept in the transfer cache.
+	shutit.build['transfer_cache_max_mb']      = cp.getint('build', 'transfer_cache_max_mb')
+	# Whether to keep each module's shell open between phases (see shutit.module_login).
+	shutit.build['warm_module_shells']         = cp.getboolean('build', 'warm_module_shells')
 	shutit.build['vagrant_run_dir']            = None
 	shutit.build['this_vagrant_run_dir']       = None
 	# Signals are set here, which is useful for context-switching callbacks.
@@ -344,7 +449,7 @@ def get_base_config(shutit, cfg_parser):
 	shutit.host['dns']                         = cp.get('host', 'dns')
 	shutit.host['password']                    = cp.get('host', 'password')
 	if isinstance(shutit.host['password'],str):
-		shutit_global.shutit_global_object.secret_words_set.add(shutit.host['password'])
+		shutit_global.shutit_global_object.add_secret_word(shutit.host['password'])
 	shutit_global.shutit_global_object.logfile = cp.get('host', 'logfile')
 	shutit.host['shutit_module_path']          = cp.get('host', 'shutit_module_path').split(':')
 	# repository - information relating to repository/registry
@@ -359,7 +464,7 @@ def get_base_config(shutit, cfg_parser):
 	shutit.repository['user']                  = cp.get('repository', 'user')
 	shutit.repository['password']              = cp.get('repository', 'password')
 	if isinstance(shutit.repository['password'],str):
-		shutit_global.shutit_global_object.secret_words_set.add(shutit.repository['password'])
+		shutit_global.shutit_global_object.add_secret_word(shutit.repository['password'])
 	shutit.repository['email']                 = cp.get('repository', 'email')
 	shutit.repository['tag_name']              = cp.get('repository', 'tag_name')
 	# END Read from config files
@@ -1164,6 +1269,18 @@ def build_report(shutit, msg=''):
 
 	if 'container_id' in shutit.target:
 		s += '# CONTAINER_ID: ' + shutit.target['container_id'] + '\n'
+	for shutit_pexpect_session_id in shutit.shutit_pexpect_sessions:
+		shutit_pexpect_session = shutit.shutit_pexpect_sessions[shutit_pexpect_session_id]
+		s += '# EXPECT CACHE (' + shutit_pexpect_session_id + '): ' + str(shutit_pexpect_session.expect_cache_hits) + ' hits, ' + str(shutit_pexpect_session.expect_cache_misses) + ' misses\n'
+		if shutit_pexpect_session.zero_delay_send:
+			s += '# ZERO DELAY SEND (' + shutit_pexpect_session_id + '): ' + str(shutit_pexpect_session.zero_delay_sends) + ' sends, ' + '%.2f' % shutit_pexpect_session.delay_saved_seconds + 's of sleep saved\n'
+	for environment in shutit.shutit_pexpect_session_environments:
+		lookups = environment.fact_cache_hits + environment.fact_cache_misses
+		if lookups > 0:
+			s += '# FACT CACHE (' + environment.environment_id + '): ' + str(environment.fact_cache_hits) + ' hits, ' + str(environment.fact_cache_misses) + ' misses (' + str(100 * environment.fact_cache_hits // lookups) + '% hit rate)\n'
+		transfers = environment.transfer_cache_hits + environment.transfer_cache_misses
+		if transfers > 0:
+			s += '# TRANSFER CACHE (' + environment.environment_id + '): ' + str(environment.transfer_cache_hits) + ' hits, ' + str(environment.transfer_cache_misses) + ' misses (' + str(100 * environment.transfer_cache_hits // transfers) + '% hit rate)\n'
 	s += '# BUILD REPORT FOR BUILD END ' + shutit.build['build_id'] + '\n'
 	s += '###############################################################################\n'
 	return s
@@ -1324,6 +1441,7 @@ def ctrl_c_signal_handler(_,frame):
 			return
 		print(colourise(31,"\r" + r"You may need to wait for a command to complete before a pause point is available. Alternatively, CTRL-\ to quit."))
 		shutit.build['ctrlc_stop'] = True
+		wake_ctrlc_waiters()
 		t = threading.Thread(target=ctrlc_background)
 		t.daemon = True
 		t.start()
@@ -1352,6 +1470,46 @@ def get_shutit_frame(frame):
 			return frame
 		return get_shutit_frame(frame.f_back)
 ctrl_c_calls = 0
+
+
+# Self-pipe written to by the CTRL-C handler, so that waits for output can be
+# woken up immediately rather than polling.
+ctrlc_pipe = None
+def get_ctrlc_pipe():
+	global ctrlc_pipe
+	if ctrlc_pipe is None:
+		ctrlc_pipe = os.pipe()
+		for fd in ctrlc_pipe:
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+	return ctrlc_pipe
+
+
+def wake_ctrlc_waiters():
+	"""Wakes up anything blocked in wait_for_input. Safe to call from a signal handler.
+	"""
+	if ctrlc_pipe is not None:
+		try:
+			os.write(ctrlc_pipe[1], b'x')
+		except OSError:
+			pass
+
+
+def wait_for_input(fd, timeout):
+	"""Blocks until the passed-in file descriptor has data to read, CTRL-C is
+	hit, or the timeout (in seconds) passes, whichever comes first.
+	"""
+	ctrlc_fd = get_ctrlc_pipe()[0]
+	try:
+		readable = select.select([fd, ctrlc_fd], [], [], timeout)[0]
+	except (select.error, OSError, IOError):
+		# Interrupted by a signal - let the caller check its state.
+		return
+	if ctrlc_fd in readable:
+		try:
+			while os.read(ctrlc_fd, 1024):
+				pass
+		except OSError:
+			pass
 # CTRL-C HANDLING CODE ENDS
 
 
@@ -1364,12 +1522,26 @@ def print_frame_recurse(frame):
 		print_frame_recurse(frame.f_back)
 
 
+def compile_regexp(regex, flags=0):
+	"""Returns the compiled regexp, from a cache of the most recently used
+	ones. Raises re.error if the regexp is invalid.
+	"""
+	key = (regex, flags)
+	compiled = compiled_regexps.pop(key, None)
+	if compiled is None:
+		compiled = re.compile(regex, flags)
+		if len(compiled_regexps) >= compiled_regexps_max:
+			compiled_regexps.popitem(last=False)
+	compiled_regexps[key] = compiled
+	return compiled
+
+
 def check_regexp(regex):
 	if regex is None:
 		# Is this ok?
 		return True
 	try:
-		re.compile(regex)
+		compile_regexp(regex)
 		result = True
 	except re.error:
 		result = False
@@ -1600,6 +1772,15 @@ def handle_exit(shutit=None, exit_code=0,loglevel=logging.DEBUG,msg=None):
 		if exit_code != 0:
 			shutit.log('Exiting with error code: ' + str(exit_code),level=loglevel)
 			shutit.log('Resetting terminal',level=loglevel)
+	# Shells parked with park_login are stopped jobs, which stop the shells
+	# below them from exiting, so log out of them first if they are still there.
+	for shutit_object in shutit_global.shutit_global_object.shutit_objects:
+		for shutit_pexpect_session in list(shutit_object.shutit_pexpect_sessions.values()):
+			if shutit_pexpect_session.parked_logins:
+				try:
+					shutit_pexpect_session.logout_parked()
+				except (Exception, SystemExit):
+					pass
 	sanitize_terminal()
 	sys.exit(exit_code)
 
@@ -1632,24 +1813,32 @@ def match_string(shutit, string_to_match, regexp):
 	"""
 	if not isinstance(string_to_match, str):
 		return None
-	lines = string_to_match.split('\r\n')
-	# sometimes they're separated by just a carriage return...
-	new_lines = []
-	for line in lines:
-		new_lines = new_lines + line.split('\r')
-	# and sometimes they're separated by just a newline...
-	for line in lines:
-		new_lines = new_lines + line.split('\n')
-	lines = new_lines
 	if not check_regexp(regexp):
 		shutit.fail('Illegal regexp found in match_string call: ' + regexp) # pragma: no cover
-	for line in lines:
-		match = re.match(regexp, line)
-		if match is not None:
-			if len(match.groups()) > 0:
-				return match.group(1)
-			else:
-				return True
+	# Lines may be separated by \r\n, \r or \n, so normalise to \n.
+	string_to_match = string_to_match.replace('\r\n','\n').replace('\r','\n')
+	# Search the whole string in one pass, matching at the start of each line.
+	try:
+		line_regexp = compile_regexp('^(?:' + regexp + ')', re.MULTILINE)
+	except re.error:
+		# eg the regexp has flags in it, which must come first.
+		line_regexp = None
+	match = None
+	if line_regexp is not None:
+		match = line_regexp.search(string_to_match)
+	if line_regexp is None or (match is not None and '\n' in match.group(0)):
+		# The match ran over the end of a line (eg with \s*), so match line by line.
+		match = None
+		compiled = compile_regexp(regexp)
+		for line in string_to_match.split('\n'):
+			match = compiled.match(line)
+			if match is not None:
+				break
+	if match is not None:
+		if len(match.groups()) > 0:
+			return match.group(1)
+		else:
+			return True
 	return None
 # alias for back-compatibility
 get_re_from_child = match_string
@@ -1819,6 +2008,41 @@ base_image:ubuntu:14.04
 dotest:yes
 # --net argument to docker, eg "bridge", "none", "container:<name|id>" or "host". Empty means use default (bridge).
 net:
+# Whether to read the exit code of each command from the prompt rather than
+# asking for it separately.
+exit_code_in_prompt:yes
+# Whether to have shells that can see the host's filesystem report each
+# command's exit code over a FIFO, rather than via the terminal.
+control_channel:no
+# Whether to skip pexpect's delay before sending (delaybeforesend) when the
+# shell is known to be waiting at its prompt.
+zero_delay_send:no
+# Whether to remember facts about each shell (whoami, command_available etc)
+# until they may have changed (eg on login, logout, install or remove).
+fact_cache:yes
+# Whether to search only the tail of the output when waiting for a prompt, so
+# that very large outputs (eg cat of a big file) take linear time.
+bounded_prompt_search:yes
+# Whether to send files to bash targets in bounded-size compressed frames,
+# checking their sha256 before moving them into place.
+chunked_send_file:yes
+# Whether to pipe files for docker targets straight into 'docker exec -i'
+# from ShutIt, rather than through a temporary file and the host's shell.
+docker_exec_send_file:yes
+# Whether send_host_dir should by default compare checksums with the files
+# already on the target, and send only those that are new or changed.
+delta_send_host_dir:no
+# Whether send_file should keep a copy of each file it sends on the target,
+# keyed by its sha256, and copy from there when the same file is sent again.
+# The copies are kept in the build's state directory, readable only by the
+# build user, and removed at the end of the build. Not used for docker or
+# dockerfile delivery, as the copies would end up in the image.
+transfer_cache:no
+# Maximum size in MB of the files kept in the transfer cache.
+transfer_cache_max_mb:1024
+# Whether to keep each module's shell open (suspended) between the check_ready,
+# remove, build, test and finalize phases, rather than logging in afresh.
+warm_module_shells:no
 '''
 
 _build_section = '''